@@ -35,6 +35,7 @@ if [[ -d "$INSTALL_DIR" ]]; then
     mkdir -p "$BACKUP_DIR"
     echo "💾 Haciendo backup de config.json y static en $BACKUP_DIR..."
     [[ -f "$INSTALL_DIR/config.json" ]] && cp "$INSTALL_DIR/config.json" "$BACKUP_DIR/"
+    [[ -f "$INSTALL_DIR/config.journal" ]] && cp "$INSTALL_DIR/config.journal" "$BACKUP_DIR/"
     [[ -d "$INSTALL_DIR/static" ]] && cp -r "$INSTALL_DIR/static" "$BACKUP_DIR/"
     echo "🗑 Borrando directorio viejo $INSTALL_DIR..."
     rm -rf "$INSTALL_DIR"
@@ -48,6 +49,7 @@ git clone "$REPO_URL" "$INSTALL_DIR"
 if [[ -n "$BACKUP_DIR" && -d "$BACKUP_DIR" ]]; then
     echo "🔄 Restaurando config.json y static..."
     [[ -f "$BACKUP_DIR/config.json" ]] && cp "$BACKUP_DIR/config.json" "$INSTALL_DIR/"
+    [[ -f "$BACKUP_DIR/config.journal" ]] && cp "$BACKUP_DIR/config.journal" "$INSTALL_DIR/"
     [[ -d "$BACKUP_DIR/static" ]] && cp -r "$BACKUP_DIR/static" "$INSTALL_DIR/"
 fi
 
@@ -61,16 +63,40 @@ else
     echo "⚠️ No se encontró requirements.txt en el repo."
 fi
 
-# --- Crear servicio systemd ---
-echo "⚙️ Creando servicio systemd..."
+# --- Puerto (se conserva el de config.json si existe) ---
+PORT=$($PYTHON_BIN -c 'import json,sys; print(json.load(open(sys.argv[1])).get("port", 4080))' "$INSTALL_DIR/config.json" 2>/dev/null || echo 4080)
+
+# --- Crear socket y servicio systemd ---
+# El socket lo mantiene systemd: durante un reinicio las conexiones esperan en
+# la cola en vez de rechazarse. "reload" (SIGHUP) releva el proceso sin cortes.
+SOCKET_FILE="/etc/systemd/system/$APP_NAME.socket"
+OLD_LISTEN=$(grep -s '^ListenStream=' "$SOCKET_FILE" || true)
+echo "⚙️ Creando socket y servicio systemd (puerto $PORT)..."
+cat > "$SOCKET_FILE" <<EOL
+[Unit]
+Description=RadioStream Socket
+
+[Socket]
+ListenStream=0.0.0.0:$PORT
+NoDelay=true
+
+[Install]
+WantedBy=sockets.target
+EOL
+
 cat > "$SERVICE_FILE" <<EOL
 [Unit]
 Description=RadioStream Service
 After=network.target
+Requires=$APP_NAME.socket
 
 [Service]
+Type=notify
+NotifyAccess=all
 WorkingDirectory=$INSTALL_DIR
 ExecStart=$PYTHON_BIN $INSTALL_DIR/main.py
+ExecReload=/bin/kill -HUP \$MAINPID
+TimeoutStopSec=40
 Restart=always
 User=root
 
@@ -79,9 +105,19 @@ WantedBy=multi-user.target
 EOL
 
 # --- Activar servicio ---
+# Un reload no vuelve a enlazar el socket de systemd: si el puerto cambió hay
+# que reiniciar socket y servicio (corte breve, inevitable al cambiar de puerto).
 systemctl daemon-reload
-systemctl enable "$APP_NAME"
-systemctl restart "$APP_NAME"
+systemctl enable "$APP_NAME.socket" "$APP_NAME"
+if [ "$OLD_LISTEN" = "ListenStream=0.0.0.0:$PORT" ] \
+        && systemctl is-active --quiet "$APP_NAME.socket" && systemctl is-active --quiet "$APP_NAME"; then
+    echo "🔁 Relevando el proceso sin cortar conexiones..."
+    systemctl reload "$APP_NAME"
+else
+    systemctl stop "$APP_NAME" || true
+    systemctl restart "$APP_NAME.socket"
+    systemctl restart "$APP_NAME"
+fi
 
 echo "✅ Instalación completada. Servicio '$APP_NAME' activo."
 echo "👉 Ver logs: journalctl -u $APP_NAME -f"
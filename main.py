@@ -4,17 +4,26 @@ RadioStream - main.py
 Este código está bajo GNU GPLv3
 """
 import os
+import sys
+import atexit
+import copy
 import json
+import time
+import hashlib
+import signal
 import secrets
+import threading
+import queue
+import tempfile
+from collections import deque, OrderedDict
 from functools import wraps
 from pathlib import Path
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
 
 from flask import (
-    Flask, request, render_template_string, redirect, url_for,
-    session, flash
+    Flask, request, render_template, redirect, url_for,
+    session, flash, jsonify
 )
+from flask.sessions import SecureCookieSessionInterface
 
 # ---------------- Paths y constantes ----------------
 BASE_DIR = Path(__file__).resolve().parent
@@ -38,8 +47,209 @@ DEFAULT_THEME = {
     "muted": "#9fb3cf"
 }
 
+# ---------------- Compilador de tema ----------------
+# Los colores no se incrustan en cada página: cada tema efectivo se valida y se
+# compila una vez a static/theme-<hash>.css. Un cambio de tema es un fichero
+# nuevo (inmutable, cacheable para siempre) y el HTML sólo cambia el enlace.
+THEME_VARS = (
+    ("--body-bg", "body_bg"), ("--card-bg", "card_bg"), ("--cover-bg", "cover_bg"),
+    ("--accent1", "accent1"), ("--accent2", "accent2"),
+    ("--text-color", "text"), ("--text", "text"), ("--muted", "muted"),
+)
+GRADIENT_FIELDS = {"body_bg", "card_bg", "cover_bg"}
+THEME_KEEP = 8      # ficheros de tema antiguos que se conservan para cachés que aún los pidan
+
+_CSS_FUNCTIONS = ("rgb(", "rgba(", "hsl(", "hsla(")
+_GRADIENTS = ("linear-gradient(", "radial-gradient(", "conic-gradient(",
+              "repeating-linear-gradient(", "repeating-radial-gradient(")
+_CSS_SAFE = set("abcdefghijklmnopqrstuvwxyz0123456789#%., ()/+-")
+
+def _balanced(value):
+    depth = 0
+    for c in value:
+        depth += (c == "(") - (c == ")")
+        if depth < 0:
+            return False
+    return depth == 0
+
+def css_color(value):
+    """Valida un color CSS (#hex, rgb()/hsl() o nombre) y lo normaliza."""
+    v = value.strip().lower() if isinstance(value, str) else ""
+    if v.startswith("#"):
+        if len(v) in (4, 5, 7, 9) and all(c in "0123456789abcdef" for c in v[1:]):
+            return v
+    elif v.startswith(_CSS_FUNCTIONS):
+        inner = v[v.index("(") + 1:-1]
+        if v.endswith(")") and inner and all(c in "0123456789., %/deg" for c in inner):
+            return v
+    elif v.isalpha() and len(v) <= 20:
+        return v
+    raise ValueError(f"Color inválido: {value!r}.")
+
+def css_background(value):
+    """Como css_color, pero admite también degradados (linear/radial/conic-gradient)."""
+    v = value.strip().lower() if isinstance(value, str) else ""
+    if not v.startswith(_GRADIENTS):
+        return css_color(value)
+    # sin ; { } < > ni comillas no se puede salir de la declaración CSS
+    if v.endswith(")") and len(v) <= 300 and set(v) <= _CSS_SAFE and _balanced(v):
+        return " ".join(v.split())
+    raise ValueError(f"Degradado inválido: {value!r}.")
+
+def validate_theme(theme):
+    """Valida los campos de tema presentes y devuelve sus valores normalizados."""
+    if not isinstance(theme, dict):
+        raise ValueError("El tema debe ser un objeto.")
+    unknown = set(theme) - set(DEFAULT_THEME) - {"card_hex"}
+    if unknown:
+        raise ValueError(f"Campos de tema desconocidos: {', '.join(sorted(unknown))}.")
+    clean = {}
+    for key, value in theme.items():
+        check = css_background if key in GRADIENT_FIELDS else css_color
+        try:
+            clean[key] = check(value)
+        except ValueError as e:
+            raise ValueError(f"{key}: {e}")
+    return clean
+
+_theme_files = {}
+_theme_lock = threading.Lock()
+
+def theme_stylesheet(theme):
+    """Nombre del theme-<hash>.css para `theme`; lo genera en static/ si no existe."""
+    merged = {**DEFAULT_THEME, **(theme or {})}
+    key = json.dumps(merged, sort_keys=True)
+    name = _theme_files.get(key)
+    if name:
+        return name
+    with _theme_lock:
+        name = _theme_files.get(key)
+        if name:
+            return name
+        values = {}
+        for field, default in DEFAULT_THEME.items():
+            try:
+                values[field] = validate_theme({field: merged[field]})[field]
+            except ValueError as e:
+                # config.json editado a mano: el campo roto vuelve al valor por defecto
+                app.logger.warning("Tema: %s", e)
+                values[field] = default
+        css = ":root{" + "".join(f"{var}:{values[field]};" for var, field in THEME_VARS) + "}\n"
+        name = f"theme-{hashlib.sha256(css.encode()).hexdigest()[:12]}.css"
+        if not asset_exists(name):
+            _atomic_write(STATIC_DIR / name, css)
+            register_asset(name)
+        if len(_theme_files) > 64:
+            _theme_files.clear()
+        _theme_files[key] = name
+        return name
+
+def compile_themes():
+    """Genera de antemano las hojas del tema base y de cada franja programada,
+    para que ninguna petición tenga que escribir en static/."""
+    themes = [config.get("theme")]
+    themes += [effective_config(slot)["theme"] for slot in _schedule_slots if slot and "theme" in slot.get("overrides", {})]
+    used = set()
+    for theme in themes:
+        try:
+            used.add(theme_stylesheet(theme))
+        except OSError as e:
+            app.logger.warning("No se pudo generar la hoja del tema: %s", e)
+            return
+    _prune_themes(used)
+
+def _prune_themes(used):
+    """Borra las hojas antiguas sobrantes; nunca las que usa la config o una franja."""
+    with _theme_lock:
+        old = sorted((n for n in assets if n.startswith("theme-") and n not in used),
+                     key=lambda n: assets[n]["mtime"], reverse=True)
+        gone = set(old[THEME_KEEP:])
+        for name in gone:
+            (STATIC_DIR / name).unlink(missing_ok=True)
+            forget_asset(name)
+        for key in [k for k, n in _theme_files.items() if n in gone]:
+            del _theme_files[key]
+
+# ---------------- Hash de contraseñas (import diferido) ----------------
+# werkzeug.security sólo se necesita al hacer login o cambiar la contraseña,
+# así que no se importa en el arranque.
+def hash_password(password):
+    from werkzeug.security import generate_password_hash
+    return generate_password_hash(password)
+
+def check_password(pwhash, password):
+    from werkzeug.security import check_password_hash
+    return check_password_hash(pwhash, password)
+
 # ---------------- Config load/save ----------------
+# config.json es una instantánea; cada guardado añade antes una línea con el
+# delta (quién, qué, cuándo) a config.journal con fsync, y la instantánea se
+# reescribe agrupando ráfagas de guardados. Al arrancar se reaplica lo que haya
+# en el journal después de la última instantánea, así que un corte entre ambos
+# no pierde cambios. La lectura en caliente es siempre el dict en memoria.
+JOURNAL_PATH = BASE_DIR / "config.journal"
+SAVE_DELAY = 0.5        # segundos para agrupar guardados seguidos
+JOURNAL_KEEP = 200      # cambios que se conservan al compactar
+
+_save_lock = threading.RLock()
+_save_timer = None
+_persisted = {}         # último estado registrado en el journal
+_journal = []           # entradas de cambio retenidas (historial / rollback)
+_journal_seq = 0
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _atomic_write(path, data):
+    # temporal propio de cada escritura: dos hilos no se pisan el fichero a medias
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    _fsync_dir(path.parent)
+
+def _append_journal(entry):
+    with open(JOURNAL_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def _read_journal():
+    entries = []
+    try:
+        with open(JOURNAL_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break  # línea a medio escribir tras un corte
+    except FileNotFoundError:
+        pass
+    return entries
+
+def _apply_entry(cfg, entry):
+    cfg.update(entry.get("set", {}))
+    for key in entry.get("unset", []):
+        cfg.pop(key, None)
+
 def load_config():
+    global _persisted, _journal, _journal_seq
     if not CONFIG_PATH.exists():
         default = {
             "port": DEFAULT_PORT,
@@ -47,59 +257,621 @@ def load_config():
             "description": "Descripción breve de la emisora.",
             "audio_url": "",
             "username": "admin",
-            "password_hash": generate_password_hash("admin"),
+            "password_hash": hash_password("admin"),
             "secret_key": secrets.token_hex(32),
             "theme": DEFAULT_THEME,
             "background_enabled": False,
             "background_filename": "",
         }
-        save_config(default)
+        _atomic_write(CONFIG_PATH, json.dumps(default, indent=2, ensure_ascii=False))
+        _persisted = json.loads(json.dumps(default))
         return default
     with open(CONFIG_PATH, "r", encoding="utf-8") as f:
         cfg = json.load(f)
+
+    last_snapshot = 0
+    for entry in _read_journal():
+        if entry.get("snapshot"):
+            last_snapshot = entry.get("seq", 0)
+            continue
+        _journal.append(entry)
+        _journal_seq = max(_journal_seq, entry.get("seq", 0))
+    pending = [e for e in _journal if e["seq"] > last_snapshot]
+    for entry in pending:
+        _apply_entry(cfg, entry)
+    _journal = _journal[-JOURNAL_KEEP:]
+
     cfg.setdefault("port", DEFAULT_PORT)
     cfg.setdefault("station_label", "RadioStream")
     cfg.setdefault("description", "Descripción breve de la emisora.")
     cfg.setdefault("audio_url", "")
     cfg.setdefault("username", "admin")
-    cfg.setdefault("password_hash", generate_password_hash("admin"))
+    # setdefault evaluaría el hash (caro) en cada arranque aunque ya exista
+    if "password_hash" not in cfg:
+        cfg["password_hash"] = hash_password("admin")
     cfg.setdefault("secret_key", secrets.token_hex(32))
     cfg.setdefault("theme", DEFAULT_THEME)
     cfg.setdefault("background_enabled", False)
     cfg.setdefault("background_filename", "")
+    _persisted = json.loads(json.dumps(cfg))
+    if pending:
+        flush_config(force=True)
     return cfg
 
-def save_config(cfg):
-    tmp = CONFIG_PATH.with_suffix(".tmp")
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, indent=2, ensure_ascii=False)
-    tmp.replace(CONFIG_PATH)
+def save_config(cfg, actor=None):
+    """Registra el delta respecto al último guardado y programa la instantánea."""
+    global _persisted, _journal_seq, _save_timer
+    with _save_lock:
+        current = json.loads(json.dumps(cfg))
+        changed = {k: v for k, v in current.items() if k not in _persisted or _persisted[k] != v}
+        removed = [k for k in _persisted if k not in current]
+        if not changed and not removed:
+            return
+        _journal_seq += 1
+        entry = {
+            "seq": _journal_seq,
+            "ts": time.time(),
+            "who": actor,
+            "set": changed,
+            "unset": removed,
+            "old": {k: _persisted[k] for k in list(changed) + removed if k in _persisted},
+        }
+        _append_journal(entry)
+        _journal.append(entry)
+        _persisted = current
+        if _save_timer is None:
+            _save_timer = threading.Timer(SAVE_DELAY, flush_config)
+            _save_timer.daemon = True
+            _save_timer.start()
+    apply_config_change(set(changed) | set(removed))
+
+# Quien mantenga estado derivado de la config (cachés, exportación...) se
+# registra aquí y recibe el conjunto de claves efectivas que han cambiado.
+_config_listeners = []
+
+def on_config_change(fn):
+    _config_listeners.append(fn)
+    return fn
+
+def _notify_listeners(keys):
+    for fn in list(_config_listeners):
+        try:
+            fn(keys)
+        except Exception:
+            app.logger.exception("Error aplicando cambio de configuración")
+
+def flush_config(force=False):
+    """Escribe la instantánea pendiente (fsync del fichero y del directorio)."""
+    global _save_timer, _journal
+    with _save_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+            _save_timer = None
+        elif not force:
+            return
+        _atomic_write(CONFIG_PATH, json.dumps(_persisted, indent=2, ensure_ascii=False))
+        _append_journal({"seq": _journal_seq, "ts": time.time(), "snapshot": True})
+        if len(_journal) > 2 * JOURNAL_KEEP:
+            compact_journal()
+
+def compact_journal(keep=JOURNAL_KEEP):
+    """Reescribe el journal conservando sólo los últimos cambios."""
+    global _journal
+    with _save_lock:
+        _journal = _journal[-keep:]
+        lines = [json.dumps(e, ensure_ascii=False) for e in _journal]
+        lines.append(json.dumps({"seq": _journal_seq, "ts": time.time(), "snapshot": True}))
+        _atomic_write(JOURNAL_PATH, "\n".join(lines) + "\n")
+
+_SECRET_KEYS = {"password_hash", "secret_key"}
+
+def config_history(limit=20):
+    """Últimos cambios, del más reciente al más antiguo, sin valores sensibles."""
+    def mask(values):
+        return {k: ("•••" if k in _SECRET_KEYS else v) for k, v in values.items()}
+    with _save_lock:
+        recent = _journal[-limit:]
+    return [
+        {"seq": e["seq"], "ts": e["ts"], "who": e.get("who"),
+         "set": mask(e.get("set", {})), "unset": e.get("unset", [])}
+        for e in reversed(recent)
+    ]
+
+def rollback_config(cfg, seq, actor=None):
+    """Deshace los cambios posteriores a `seq` aplicando sus deltas inversos."""
+    with _save_lock:
+        newer = [e for e in _journal if e["seq"] > seq]
+        if not newer:
+            return False
+        if seq < _journal[0]["seq"] - 1:
+            raise ValueError("El cambio pedido ya no está en el journal (compactado).")
+        for entry in reversed(newer):
+            for key in list(entry.get("set", {})) + entry.get("unset", []):
+                if key in entry.get("old", {}):
+                    cfg[key] = entry["old"][key]
+                else:
+                    cfg.pop(key, None)
+        save_config(cfg, actor=actor or f"rollback:{seq}")
+    return True
 
 config = load_config()
+atexit.register(flush_config)
 
 # ---------------- Flask app ----------------
 app = Flask(__name__, static_folder=str(STATIC_DIR))
 app.secret_key = config.get("secret_key") or secrets.token_hex(32)
+app.jinja_env.filters["fecha"] = lambda ts: time.strftime("%d/%m %H:%M", time.localtime(ts))
+
+_default_max_age = app.get_send_file_max_age
+
+def _static_max_age(filename):
+    # theme-<hash>.css nunca cambia de contenido: se puede cachear un año
+    if filename and os.path.basename(filename).startswith("theme-"):
+        return 31536000
+    return _default_max_age(filename)
+
+app.get_send_file_max_age = _static_max_age
 
 # ---------------- Utilidades ----------------
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# ---------------- Vista precalculada por secciones ----------------
+# Lo que las rutas calientes sacan de la config (contexto y HTML de las páginas
+# públicas, station.json, formulario de admin, usuario válido) se calcula una
+# vez por host y se comparte. Un cambio sólo descarta las secciones que
+# dependen de las claves tocadas: "assets" representa el contenido de static/
+# y "transcode" los escalones de transcodificación disponibles.
+VIEW_CACHE_HOSTS = 32
+PUBLIC_KEYS = {"station_label", "description", "audio_url", "theme", "cover_filename",
+               "background_enabled", "background_filename", "schedule", "assets",
+               "relay_enabled", "player_buffer", "transcode_enabled", "transcode_bitrates", "transcode"}
+VIEW_DEPS = {
+    "public": PUBLIC_KEYS,
+    "station": PUBLIC_KEYS - {"background_enabled", "background_filename"},
+    "admin": PUBLIC_KEYS | {"port"},
+    "username": {"username"},
+}
+
+_views = {}
+_views_epoch = 0
+_views_lock = threading.Lock()
+
+def invalidate_views(keys=None):
+    """Descarta las secciones afectadas por keys (todas si es None)."""
+    global _views, _views_epoch
+    with _views_lock:
+        _views_epoch += 1
+        if keys is None:
+            _views = {}
+        else:
+            _views = {host: {name: value for name, value in sections.items() if not VIEW_DEPS[name] & keys}
+                      for host, sections in _views.items()}
+
+on_config_change(invalidate_views)
+
+# ---------------- Registro de assets estáticos ----------------
+# Qué hay en static/ (tamaño, hash, mtime) se aprende con un escaneo al
+# arrancar y se actualiza desde las subidas/borrados de admin() o desde el
+# vigilante opcional; las peticiones sólo consultan este dict, sin stat().
+# Se sustituye entero en cada cambio, así que leerlo no necesita lock.
+ASSET_WATCH_INTERVAL = 30   # segundos; "asset_watch_interval": 0 lo desactiva
+
+assets = {}
+_assets_lock = threading.Lock()
+
+def _asset_info(path, st=None):
+    st = st or path.stat()
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return {"size": st.st_size, "mtime": st.st_mtime, "sha256": h.hexdigest()}
+
+def scan_assets():
+    """Reconstruye el registro; sólo rehashea ficheros nuevos o modificados."""
+    global assets
+    with _assets_lock:
+        found = {}
+        with os.scandir(STATIC_DIR) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                st = entry.stat()
+                known = assets.get(entry.name)
+                if known and known["size"] == st.st_size and known["mtime"] == st.st_mtime:
+                    found[entry.name] = known
+                else:
+                    found[entry.name] = _asset_info(Path(entry.path), st)
+        changed = found != assets
+        assets = found
+    if changed:
+        invalidate_views({"assets"})
+    return changed
+
+def register_asset(name):
+    global assets
+    with _assets_lock:
+        assets = {**assets, name: _asset_info(STATIC_DIR / name)}
+    invalidate_views({"assets"})
+
+def forget_asset(name):
+    global assets
+    with _assets_lock:
+        assets = {k: v for k, v in assets.items() if k != name}
+    invalidate_views({"assets"})
+
+def asset_exists(name):
+    return name in assets
+
 def cover_exists():
-    return (STATIC_DIR / COVER_FILENAME).exists()
+    return COVER_FILENAME in assets
 
 def background_exists():
-    return (STATIC_DIR / BACKGROUND_FILENAME).exists()
+    return BACKGROUND_FILENAME in assets
+
+def _watch_assets(interval):
+    while not shutting_down.wait(interval):
+        try:
+            if scan_assets():
+                schedule_static_export()
+        except OSError as e:
+            app.logger.debug("No se pudo escanear static/: %s", e)
+
+def start_asset_watcher():
+    interval = config.get("asset_watch_interval", ASSET_WATCH_INTERVAL)
+    if interval:
+        threading.Thread(target=_watch_assets, args=(interval,), daemon=True).start()
+
+scan_assets()
+
+# ---------------- Programación horaria ----------------
+# config["schedule"] es una lista de franjas que sobrescriben algunos campos:
+#   {"name": "Mañanas", "days": [0,1,2,3,4], "start": "07:00", "end": "10:00",
+#    "overrides": {"station_label": "...", "audio_url": "...", "theme": {...}}}
+# (days: 0 = lunes; sin "days" aplica todos los días; end <= start cruza la
+# medianoche). Las franjas se indexan en minutos de la semana; un temporizador
+# cambia la vista activa justo en cada frontera, así que cada petición sólo lee
+# una referencia ya calculada.
+SCHEDULE_FIELDS = ("station_label", "description", "audio_url", "cover_filename", "theme")
+WEEK_MINUTES = 7 * 24 * 60
+
+_schedule_bounds = [0]      # inicio (minuto de la semana) de cada segmento
+_schedule_slots = [None]    # franja activa en cada segmento
+_schedule_timer = None
+_schedule_lock = threading.Lock()
+active = {"slot": None, "config": config}
+
+def _parse_hhmm(value):
+    try:
+        hh, mm = str(value).split(":")
+        hh, mm = int(hh), int(mm)
+    except ValueError:
+        raise ValueError(f"Hora inválida: {value!r} (usa HH:MM).")
+    if not (0 <= hh <= 23 and 0 <= mm <= 59):
+        raise ValueError(f"Hora fuera de rango: {value!r}.")
+    return hh * 60 + mm
+
+def parse_schedule(text):
+    """Valida la programación (JSON) enviada desde /admin."""
+    text = (text or "").strip()
+    if not text:
+        return []
+    try:
+        slots = json.loads(text)
+    except ValueError as e:
+        raise ValueError(f"La programación no es JSON válido: {e}")
+    if not isinstance(slots, list):
+        raise ValueError("La programación debe ser una lista de franjas.")
+    for i, slot in enumerate(slots, 1):
+        if not isinstance(slot, dict):
+            raise ValueError(f"Franja {i}: debe ser un objeto.")
+        _parse_hhmm(slot.get("start"))
+        _parse_hhmm(slot.get("end"))
+        days = slot.get("days", list(range(7)))
+        if not isinstance(days, list) or any(d not in range(7) for d in days):
+            raise ValueError(f"Franja {i}: 'days' debe ser una lista de 0 (lunes) a 6 (domingo).")
+        overrides = slot.get("overrides", {})
+        if not isinstance(overrides, dict):
+            raise ValueError(f"Franja {i}: 'overrides' debe ser un objeto.")
+        unknown = set(overrides) - set(SCHEDULE_FIELDS)
+        if unknown:
+            raise ValueError(f"Franja {i}: campos no programables: {', '.join(sorted(unknown))}.")
+        if "theme" in overrides:
+            try:
+                overrides["theme"] = validate_theme(overrides["theme"])
+            except ValueError as e:
+                raise ValueError(f"Franja {i}: {e}")
+        slot.setdefault("name", f"Franja {i}")
+    return slots
+
+def _slot_intervals(slot):
+    start, end = _parse_hhmm(slot["start"]), _parse_hhmm(slot["end"])
+    length = (end - start) % (24 * 60) or 24 * 60
+    for day in slot.get("days", range(7)):
+        a = day * 24 * 60 + start
+        b = a + length
+        if b <= WEEK_MINUTES:
+            yield a, b
+        else:  # domingo -> lunes
+            yield a, WEEK_MINUTES
+            yield 0, b - WEEK_MINUTES
+
+def build_schedule_index(slots):
+    """Devuelve (fronteras, franja por segmento); la última franja listada gana."""
+    intervals = [(a, b, slot) for slot in slots for a, b in _slot_intervals(slot)]
+    points = sorted({0} | {a for a, _, _ in intervals} | {b for _, b, _ in intervals if b < WEEK_MINUTES})
+    bounds, owners = [], []
+    for point in points:
+        owner = None
+        for a, b, slot in intervals:
+            if a <= point < b:
+                owner = slot
+        if owners and owners[-1] is owner:
+            continue
+        bounds.append(point)
+        owners.append(owner)
+    return bounds, owners
+
+def _week_minute(now):
+    return now.weekday() * 24 * 60 + now.hour * 60 + now.minute + (now.second + now.microsecond / 1e6) / 60
+
+def effective_config(slot):
+    if not slot:
+        return config
+    merged = dict(config)
+    for key, value in slot.get("overrides", {}).items():
+        if key == "theme":
+            merged["theme"] = {**config.get("theme", DEFAULT_THEME), **value}
+        else:
+            merged[key] = value
+    return merged
+
+def _apply_schedule():
+    """Recalcula la vista activa y arma el temporizador para la próxima frontera."""
+    global active, _schedule_timer
+    from bisect import bisect_right
+    from datetime import datetime
+
+    with _schedule_lock:
+        if _schedule_timer is not None:
+            _schedule_timer.cancel()
+            _schedule_timer = None
+        minute = _week_minute(datetime.now())
+        i = bisect_right(_schedule_bounds, minute) - 1
+        slot = _schedule_slots[i]
+        previous = active["slot"]
+        active = {"slot": slot, "config": effective_config(slot)}
+        if len(_schedule_bounds) > 1:
+            nxt = _schedule_bounds[i + 1] if i + 1 < len(_schedule_bounds) else WEEK_MINUTES
+            delay = (nxt - minute) * 60 + 0.05
+            _schedule_timer = threading.Timer(delay, _on_schedule_boundary)
+            _schedule_timer.daemon = True
+            _schedule_timer.start()
+    return previous, slot
+
+def _on_schedule_boundary():
+    previous, slot = _apply_schedule()
+    if previous is not slot:
+        _notify_listeners(set((previous or {}).get("overrides", {})) | set((slot or {}).get("overrides", {})))
+
+def refresh_schedule():
+    global _schedule_bounds, _schedule_slots
+    try:
+        slots = parse_schedule(json.dumps(config.get("schedule", [])))
+    except ValueError as e:
+        app.logger.warning("Programación ignorada: %s", e)
+        slots = []
+    with _schedule_lock:
+        _schedule_bounds, _schedule_slots = build_schedule_index(slots)
+    compile_themes()
+    _apply_schedule()
+
+def apply_config_change(keys):
+    """Recalcula la vista efectiva tras un guardado y avisa a los listeners."""
+    if "schedule" in keys:
+        refresh_schedule()
+    else:
+        if "theme" in keys:
+            compile_themes()
+        _apply_schedule()
+    _notify_listeners(keys)
+
+refresh_schedule()
+
+# ---------------- Sesión: cookie firmada con caché de validación ----------------
+# Verificar la firma de la cookie (HMAC + JSON + zlib) en cada petición es lo
+# más caro de una visita a /admin. Como la cookie es inmutable, guardamos el
+# resultado de validarla un rato: la misma cookie no se vuelve a comprobar.
+SESSION_CACHE_SIZE = 256
+SESSION_CACHE_TTL = 60      # segundos que se confía en una cookie ya validada
+
+class CachedSessionInterface(SecureCookieSessionInterface):
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        value = request.cookies.get(self.get_cookie_name(app))
+        if not value:
+            return super().open_session(app, request)
+        now = time.monotonic()
+        with self._lock:
+            hit = self._cache.get(value)
+            if hit and hit[0] > now:
+                self._cache.move_to_end(value)
+                return self.session_class(copy.deepcopy(hit[1]))
+        s = super().open_session(app, request)
+        if s is not None and s:
+            # copia profunda: flash() añade a listas de la sesión y no debe tocar la caché
+            with self._lock:
+                self._cache[value] = (now + SESSION_CACHE_TTL, copy.deepcopy(dict(s)))
+                while len(self._cache) > SESSION_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return s
+
+    def forget(self):
+        with self._lock:
+            self._cache.clear()
+
+app.session_interface = CachedSessionInterface()
+
+@on_config_change
+def _session_on_change(keys):
+    # con otra clave o credenciales, una cookie validada antes ya no vale
+    if keys & {"secret_key", "username", "password_hash"}:
+        app.secret_key = config.get("secret_key") or app.secret_key
+        app.session_interface.forget()
 
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        if session.get("user") != config.get("username"):
+        if session.get("user") != view("username"):
             return redirect(url_for("login", next=request.path))
         return f(*args, **kwargs)
     return decorated
 
 # ---------------- Templates ----------------
+# Telemetría de calidad (QoE) de los reproductores: tiempo hasta el primer
+# audio, cortes (número y duración) y códigos de error. Se agrupa en lotes y se
+# envía con navigator.sendBeacon cada 30 s y al ocultar/cerrar la página.
+QOE_JS = """
+function rsQoE(player, kind){
+  const endpoint = "/api/qoe";
+  const MAX = 50;
+  const host = (kind === "embed" && document.referrer) ? new URL(document.referrer).host : location.host;
+  let batch = {ttfa: [], stalls: [], errors: []};
+  let requestedAt = null, stallAt = null, started = false, mirror = "";
+
+  function now(){ return performance.now(); }
+  function push(list, v){ if(list.length < MAX) list.push(Math.round(v)); }
+  function active(){ return !!player.getAttribute("src"); }
+
+  player.addEventListener("loadstart", () => {
+    if(!active()) return;
+    requestedAt = now(); started = false; stallAt = null;
+    try { mirror = new URL(player.src, location.href).host; } catch(e) { mirror = ""; }
+  });
+  player.addEventListener("playing", () => {
+    if(requestedAt !== null && !started){ push(batch.ttfa, now() - requestedAt); started = true; }
+    if(stallAt !== null){ push(batch.stalls, now() - stallAt); stallAt = null; }
+  });
+  player.addEventListener("waiting", () => { if(started && stallAt === null) stallAt = now(); });
+  player.addEventListener("error", () => { if(active() && player.error) push(batch.errors, player.error.code); });
+
+  function flush(){
+    if(!batch.ttfa.length && !batch.stalls.length && !batch.errors.length) return;
+    const body = JSON.stringify({kind, host, mirror, ttfa: batch.ttfa, stalls: batch.stalls, errors: batch.errors});
+    batch = {ttfa: [], stalls: [], errors: []};
+    if(!(navigator.sendBeacon && navigator.sendBeacon(endpoint, body))){
+      fetch(endpoint, {method: "POST", body, keepalive: true}).catch(() => {});
+    }
+  }
+  setInterval(flush, 30000);
+  document.addEventListener("visibilitychange", () => { if(document.visibilityState === "hidden") flush(); });
+  window.addEventListener("pagehide", flush);
+}
+"""
+
+
+# Control del buffer del reproductor: si el navegador acumula más de `max`
+# segundos por delante del punto de escucha, salta a `target` segundos del
+# final para no alejarse del directo. Si el stream termina (p. ej. el relay
+# cierra conexiones al relevar el proceso) se vuelve a conectar solo.
+BUFFER_JS = """
+function rsBuffer(player, opts){
+  function ahead(){
+    const b = player.buffered;
+    return b.length ? b.end(b.length - 1) - player.currentTime : 0;
+  }
+  setInterval(() => {
+    if(player.paused || !player.getAttribute("src")) return;
+    if(opts.max && ahead() > opts.max){
+      player.currentTime = player.buffered.end(player.buffered.length - 1) - opts.target;
+    }
+  }, 1000);
+  player.addEventListener("ended", () => {
+    const src = player.getAttribute("src");
+    if(src){ player.src = src; player.play().catch(() => {}); }
+  });
+}
+"""
+
+# Elección de escalón (transcodificación): se empieza por el que permita la
+# red según navigator.connection (o el del medio), se baja si el audio se
+# descarga más despacio que en tiempo real y, tras un minuto estable, se
+# prueba el siguiente: la ráfaga inicial del servidor llega a la velocidad de
+# la red, así que cronometrarla mide el ancho de banda disponible.
+ABR_JS = """
+function rsAbr(player, renditions){
+  const KEY = "radiostream_kbps";
+  let current = null, lastEnd = 0, lastAt = 0, slow = 0, good = 0;
+  function remember(k){ try { sessionStorage.setItem(KEY, k); } catch(e) {} }
+  function initial(){
+    let saved = null;
+    try { saved = Number(sessionStorage.getItem(KEY)); } catch(e) {}
+    const known = renditions.find((r) => r.kbps === saved);
+    if(known) return known;
+    const mbps = navigator.connection && navigator.connection.downlink;
+    if(mbps){
+      const fit = renditions.filter((r) => r.kbps * 2 <= mbps * 1000);
+      return fit.length ? fit[fit.length - 1] : renditions[0];
+    }
+    return renditions[Math.floor((renditions.length - 1) / 2)];
+  }
+  function switchTo(r){
+    current = r; remember(r.kbps); lastAt = 0; slow = 0; good = 0;
+    if(player.getAttribute("src")){ player.src = r.url; player.play().catch(() => {}); }
+  }
+  async function probe(r){
+    const ctl = new AbortController(), t0 = performance.now();
+    let got = 0;
+    try {
+      const reader = (await fetch(r.url, {signal: ctl.signal, cache: "no-store"})).body.getReader();
+      while(got < r.kbps * 125 && performance.now() - t0 < 3000){
+        const chunk = await reader.read();
+        if(chunk.done) break;
+        got += chunk.value.length;
+      }
+    } catch(e) {}
+    ctl.abort();
+    return got * 8 / Math.max(1, performance.now() - t0);   // kbps
+  }
+  if(renditions.length){
+    player.addEventListener("waiting", () => { if(current) slow++; });
+    setInterval(async () => {
+      if(player.paused || !player.getAttribute("src") || !current) return;
+      const b = player.buffered, end = b.length ? b.end(b.length - 1) : 0, now = performance.now() / 1000;
+      if(lastAt){
+        // segundos de audio descargados por segundo de reloj
+        const ratio = (end - lastEnd) / (now - lastAt);
+        slow = ratio < 0.9 ? slow + 1 : 0;
+        good = ratio >= 0.98 ? good + 1 : 0;
+      }
+      lastEnd = end; lastAt = now;
+      const i = renditions.indexOf(current);
+      if(slow >= 2 && i > 0){
+        switchTo(renditions[i - 1]);
+      } else if(good >= 12 && i < renditions.length - 1){
+        good = 0;
+        const up = renditions[i + 1];
+        if(await probe(up) > up.kbps * 1.5) switchTo(up);
+      }
+    }, 5000);
+  }
+  return {
+    pick(){ if(!renditions.length) return ""; current = current || initial(); return current.url; },
+    // si un escalón falla se abandona la escalera y se vuelve a la URL original
+    fallback(url){
+      if(!current || !url || player.getAttribute("src") !== current.url) return false;
+      renditions = []; current = null;
+      player.src = url; player.play().catch(() => {});
+      return true;
+    }
+  };
+}
+"""
+
 # Página pública principal (incluye modal embed con opción autoplay)
 INDEX_HTML = """
 <!doctype html>
@@ -108,16 +880,8 @@ INDEX_HTML = """
 <meta charset="utf-8">
 <meta name="viewport" content="width=device-width,initial-scale=1">
 <title>{{ station_label }} — RadioStream</title>
+<link rel="stylesheet" href="{{ theme_css }}">
 <style>
-  :root{
-    --body-bg: {{ theme.body_bg }};
-    --card-bg: {{ theme.card_bg }};
-    --cover-bg: {{ theme.cover_bg }};
-    --accent1: {{ theme.accent1 }};
-    --accent2: {{ theme.accent2 }};
-    --text-color: {{ theme.text }};
-    --muted: {{ theme.muted }};
-  }
   html,body{height:100%;margin:0}
   body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Arial;background:var(--body-bg);color:var(--text-color);display:flex;align-items:center;justify-content:center;padding:20px;min-height:100vh;overflow-x:hidden;}
   #bg { position:fixed; inset:0; z-index:0; background-position:center; background-size:cover; filter: blur(10px) saturate(1.05); transform: scale(1.05); transition: opacity .4s ease; }
@@ -168,8 +932,8 @@ INDEX_HTML = """
 </style>
 </head>
 <body>
-  {% if background_enabled and background_filename %}
-    <div id="bg" class="visible" style="background-image: url('{{ url_for('static', filename=background_filename) }}');"></div>
+  {% if background_enabled and background_url %}
+    <div id="bg" class="visible" style="background-image: url('{{ background_url }}');"></div>
     <div id="bg-overlay"></div>
   {% else %}
     <div id="bg" class="hidden"></div>
@@ -185,7 +949,7 @@ INDEX_HTML = """
     <div id="card" class="card" role="region" aria-label="RadioStream player">
       <div class="cover" aria-hidden="true">
         {% if cover %}
-          <img src="{{ url_for('static', filename=cover_filename) }}" alt="Cover">
+          <img src="{{ cover_url }}" alt="Cover">
         {% else %}
           <div class="no-cover">No cover found</div>
         {% endif %}
@@ -225,11 +989,17 @@ INDEX_HTML = """
   <!-- Modal embed -->
   <div id="embedModal" class="modal" role="dialog" aria-hidden="true">
     <div class="modal-box" role="document" aria-label="Embed code">
-      <h3>Iframe para embeber</h3>
-      <p class="small" style="color:var(--muted)">Copia el código y pégalo donde quieras.</p>
+      <h3>Código para embeber</h3>
+      <p class="small" style="color:var(--muted)">Copia el código y pégalo donde quieras. El widget es mucho más ligero que el iframe si hay varios reproductores en la página.</p>
 
       <div class="modal-row">
-        <label style="color:var(--muted)"><input type="checkbox" id="autoplayCheck"> Autoplay (&nbsp;?autoplay=1&nbsp;)</label>
+        <label style="color:var(--muted)">Formato
+          <select id="embedFormat">
+            <option value="widget" selected>Widget (script)</option>
+            <option value="iframe">iframe</option>
+          </select>
+        </label>
+        <label style="color:var(--muted)"><input type="checkbox" id="autoplayCheck"> Autoplay</label>
       </div>
 
       <textarea id="embedCode" readonly></textarea>
@@ -246,6 +1016,8 @@ INDEX_HTML = """
   const playBtn = document.getElementById("playBtn");
   const player = document.getElementById("player");
   const audioUrl = "{{ audio_url|e }}";
+  {{ abr_script|safe }}
+  const abr = rsAbr(player, {{ renditions|tojson }});
   const status = document.getElementById("status");
   const spinner = document.getElementById("spinner");
   const playIcon = document.getElementById("playIcon");
@@ -304,6 +1076,7 @@ INDEX_HTML = """
       intentionalStop = false;
       return;
     }
+    if(abr.fallback(audioUrl)) return;
     loading = false;
     playBtn.disabled = false;
     showSpinner(false);
@@ -329,7 +1102,7 @@ INDEX_HTML = """
       playBtn.disabled = true;
       showSpinner(true);
       status.textContent = "Cargando...";
-      player.src = audioUrl;
+      player.src = abr.pick() || audioUrl;
       player.crossOrigin = "anonymous";
 
       try {
@@ -375,24 +1148,29 @@ INDEX_HTML = """
   card.addEventListener("dblclick", () => { if(minimized) setMinimized(false); });
 
   // Embed modal handling
+  const embedFormat = document.getElementById("embedFormat");
+  function embedSnippet(){
+    const autoplay = autoplayCheck.checked;
+    if(embedFormat.value === "widget"){
+      const tag = autoplay ? "<radiostream-player autoplay></radiostream-player>" : "<radiostream-player></radiostream-player>";
+      return `<script src="{{ widget_url }}" async><\/script>\n${tag}`;
+    }
+    const base = "{{ embed_url }}";
+    const url = autoplay ? `${base}?autoplay=1` : base;
+    return `<iframe src="${url}" width="420" height="180" frameborder="0" allow="autoplay; encrypted-media" sandbox="allow-scripts allow-same-origin"></iframe>`;
+  }
+
   openEmbed.addEventListener("click", (e) => {
     e.preventDefault();
-    const base = "{{ embed_url }}";
     // empezamos sin autoplay
     autoplayCheck.checked = false;
-    const code = `<iframe src="${base}" width="420" height="180" frameborder="0" allow="autoplay; encrypted-media" sandbox="allow-scripts allow-same-origin"></iframe>`;
-    embedCode.value = code;
+    embedCode.value = embedSnippet();
     embedModal.classList.add("show");
     embedModal.setAttribute("aria-hidden","false");
   });
 
-  autoplayCheck.addEventListener("change", () => {
-    const base = "{{ embed_url }}";
-    const has = autoplayCheck.checked;
-    const url = has ? `${base}?autoplay=1` : base;
-    const code = `<iframe src="${url}" width="420" height="180" frameborder="0" allow="autoplay; encrypted-media" sandbox="allow-scripts allow-same-origin"></iframe>`;
-    embedCode.value = code;
-  });
+  autoplayCheck.addEventListener("change", () => { embedCode.value = embedSnippet(); });
+  embedFormat.addEventListener("change", () => { embedCode.value = embedSnippet(); });
 
   closeModal.addEventListener("click", () => {
     embedModal.classList.remove("show");
@@ -425,6 +1203,11 @@ INDEX_HTML = """
   document.addEventListener("DOMContentLoaded", () => {
     if(sessionStorage.getItem("radiostream_minimized")==="1") setMinimized(true);
   });
+
+  {{ qoe_script|safe }}
+  rsQoE(player, "pagina");
+  {{ buffer_script|safe }}
+  rsBuffer(player, {{ player_buffer|tojson }});
 </script>
 </body>
 </html>
@@ -438,13 +1221,8 @@ EMBED_HTML = """
 <meta charset="utf-8">
 <meta name="viewport" content="width=device-width,initial-scale=1">
 <title>RadioStream Embed</title>
+<link rel="stylesheet" href="{{ theme_css }}">
 <style>
-  :root{
-    --accent1: {{ theme.accent1 }};
-    --accent2: {{ theme.accent2 }};
-    --text: {{ theme.text }};
-    --muted: {{ theme.muted }};
-  }
   html,body{margin:0;padding:8px;font-family:system-ui,Arial;background:transparent;color:var(--text)}
   .box{background:rgba(10,10,10,0.6);backdrop-filter:blur(4px);border-radius:8px;padding:8px;display:flex;gap:10px;align-items:center;}
   .cover{width:64px;height:64px;border-radius:6px;overflow:hidden;background:#031018;flex:0 0 64px}
@@ -476,7 +1254,7 @@ EMBED_HTML = """
   <div class="box" role="region" aria-label="Embed RadioStream">
     <div class="cover">
       {% if cover %}
-        <img src="{{ url_for('static', filename=cover_filename) }}" alt="Cover">
+        <img src="{{ cover_url }}" alt="Cover">
       {% else %}
         <div style="display:flex;align-items:center;justify-content:center;height:100%;color:var(--muted);font-size:12px">No cover</div>
       {% endif %}
@@ -506,12 +1284,14 @@ EMBED_HTML = """
 
 <script>
   const params = new URLSearchParams(location.search);
-  const autoplay = params.get("autoplay") === "1";
+  const autoplay = {{ "true" if force_autoplay else "false" }} || params.get("autoplay") === "1";
 
   const audioUrl = "{{ audio_url|e }}";
   const play = document.getElementById("play");
   const spinner = document.getElementById("spinner");
   const player = document.getElementById("player");
+  {{ abr_script|safe }}
+  const abr = rsAbr(player, {{ renditions|tojson }});
   const volSlider = document.getElementById("volSlider");
   const volPerc = document.getElementById("volPerc");
 
@@ -531,14 +1311,14 @@ EMBED_HTML = """
 
   player.addEventListener("playing", () => { loading = false; showSpinner(false); play.textContent = "■"; playing = true; });
   player.addEventListener("pause", ()=> { if(player.src === "") { play.textContent = "▶"; playing=false; }});
-  player.addEventListener("error", (e)=>{ if(intentional){ intentional=false; return; } showSpinner(false); playing=false; play.textContent = "▶"; console.error("Embed audio error", e); });
+  player.addEventListener("error", (e)=>{ if(intentional){ intentional=false; return; } if(abr.fallback(audioUrl)) return; showSpinner(false); playing=false; play.textContent = "▶"; console.error("Embed audio error", e); });
 
   play.addEventListener("click", async ()=>{
     if(loading) return;
     if(!playing){
       if(!audioUrl){ alert("Stream no configurado"); return; }
       loading = true; intentional = false; showSpinner(true);
-      player.src = audioUrl; player.crossOrigin = "anonymous";
+      player.src = abr.pick() || audioUrl; player.crossOrigin = "anonymous";
       // aplicar volumen actual antes de play
       applyVolumeFromSlider();
       try{
@@ -571,7 +1351,7 @@ EMBED_HTML = """
       try {
         loading = true;
         showSpinner(true);
-        player.src = audioUrl;
+        player.src = abr.pick() || audioUrl;
         player.crossOrigin = "anonymous";
         applyVolumeFromSlider();
         await player.play();
@@ -583,46 +1363,310 @@ EMBED_HTML = """
       }
     }, 120);
   }
+
+  {{ qoe_script|safe }}
+  rsQoE(player, "embed");
+  {{ buffer_script|safe }}
+  rsBuffer(player, {{ player_buffer|tojson }});
 </script>
 </body>
 </html>
 """
 
+# Widget embebible: un único script (cacheable y compartido por todas las
+# instancias de la página) que define <radiostream-player>. Cada instancia usa
+# Shadow DOM con una hoja de estilos compartida, pide los datos de la emisora a
+# /api/station.json una sola vez y sólo crea el <audio> al pulsar play.
+EMBED_JS = r"""
+(function(){
+  if (window.customElements === undefined || customElements.get("radiostream-player")) return;
+
+  const script = document.currentScript;
+  const origin = new URL(script ? script.src : location.href).origin;
+
+  let stationPromise = null;
+  function station(){
+    if(!stationPromise){
+      stationPromise = fetch(origin + "/api/station.json", {credentials: "omit"})
+        .then((r) => r.ok ? r.json() : Promise.reject(new Error("HTTP " + r.status)));
+    }
+    return stationPromise;
+  }
+
+  const CSS = `
+    :host{ --accent1:#00c2a8; --accent2:#007a66; --text:#e6eef8; --muted:#9fb3cf; display:block; max-width:420px; font-family:system-ui,Arial; color:var(--text); }
+    .box{ background:rgba(10,10,10,0.6); border-radius:8px; padding:8px; display:flex; gap:10px; align-items:center; }
+    .cover{ width:64px; height:64px; border-radius:6px; overflow:hidden; background:#031018; flex:0 0 64px; }
+    .cover img{ width:100%; height:100%; object-fit:cover; display:block; }
+    .info{ flex:1; min-width:0; }
+    .title{ font-size:14px; margin:0 0 4px 0; white-space:nowrap; overflow:hidden; text-overflow:ellipsis; }
+    .desc{ font-size:11px; margin:0; color:var(--muted); white-space:nowrap; overflow:hidden; text-overflow:ellipsis; }
+    .play{ width:44px; height:44px; border-radius:50%; background:linear-gradient(180deg,var(--accent1),var(--accent2)); color:white; border:none; cursor:pointer; font-size:18px; }
+    .play[disabled]{ opacity:0.6; cursor:progress; }
+    .vol-wrap{ display:flex; flex-direction:column; align-items:center; gap:6px; width:110px; }
+    .vol-label{ font-size:11px; color:var(--muted); }
+    input[type=range]{ width:100%; accent-color:var(--accent1); }
+    .powered{ font-size:10px; color:var(--muted); text-align:center; margin-top:6px; }
+  `;
+  let sheet = null;
+  function adoptStyles(root){
+    if ("adoptedStyleSheets" in Document.prototype && "replaceSync" in CSSStyleSheet.prototype) {
+      if(!sheet){ sheet = new CSSStyleSheet(); sheet.replaceSync(CSS); }
+      root.adoptedStyleSheets = [sheet];
+    } else {
+      const style = document.createElement("style");
+      style.textContent = CSS;
+      root.appendChild(style);
+    }
+  }
+
+  const template = document.createElement("template");
+  template.innerHTML = `
+    <div class="box" role="region" aria-label="RadioStream">
+      <div class="cover"></div>
+      <div class="info"><div class="title">RadioStream</div><div class="desc"></div></div>
+      <button class="play" title="Play" aria-pressed="false">▶</button>
+      <div class="vol-wrap"><div class="vol-label">Vol: <span class="perc">100%</span></div>
+        <input class="vol" type="range" min="0" max="100" value="100" step="1" aria-label="Volumen"></div>
+    </div>
+    <div class="powered">Powered by RadioStream</div>`;
+
+  let current = null;  // sólo suena un reproductor por página
+
+  class RadioStreamPlayer extends HTMLElement {
+    connectedCallback(){
+      if(this.shadowRoot) return;
+      const root = this.attachShadow({mode: "open"});
+      adoptStyles(root);
+      root.appendChild(template.content.cloneNode(true));
+      this.el = (sel) => root.querySelector(sel);
+      this.audio = null;
+      this.playing = false;
+      this.el(".play").addEventListener("click", () => this.playing ? this.stop() : this.start());
+      this.el(".vol").addEventListener("input", () => this.applyVolume());
+      station().then((d) => this.render(d)).catch((e) => {
+        this.el(".title").textContent = "Emisora no disponible";
+        console.error("RadioStream widget:", e);
+      });
+      if(this.hasAttribute("autoplay")) station().then(() => this.start()).catch(() => {});
+    }
+
+    disconnectedCallback(){ this.stop(); this.audio = null; }
+
+    render(d){
+      this.data = d;
+      this.el(".title").textContent = d.station_label || "RadioStream";
+      this.el(".desc").textContent = d.description || "";
+      if(d.cover_url){
+        const img = document.createElement("img");
+        img.src = d.cover_url; img.alt = "Cover"; img.loading = "lazy"; img.decoding = "async";
+        this.el(".cover").replaceChildren(img);
+      }
+      const t = d.theme || {};
+      for (const k of ["accent1", "accent2", "text", "muted"]) {
+        if(t[k]) this.style.setProperty("--" + k, t[k]);
+      }
+    }
+
+    applyVolume(){
+      const v = Math.max(0, Math.min(100, Number(this.el(".vol").value)));
+      this.el(".perc").textContent = `${v}%`;
+      if(this.audio) this.audio.volume = v / 100;
+    }
+
+    ensureAudio(){
+      if(!this.audio){
+        const a = new Audio();
+        a.preload = "none";
+        a.crossOrigin = "anonymous";
+        a.addEventListener("playing", () => this.setState(true, false));
+        a.addEventListener("error", () => { if(this.playing || this.loading) this.setState(false, false); });
+        this.audio = a;
+      }
+      this.applyVolume();
+      return this.audio;
+    }
+
+    setState(playing, loading){
+      this.playing = playing;
+      this.loading = loading;
+      const btn = this.el(".play");
+      btn.disabled = loading;
+      btn.textContent = playing ? "■" : "▶";
+      btn.setAttribute("aria-pressed", playing ? "true" : "false");
+    }
+
+    async start(){
+      if(this.loading || !this.data || !this.data.audio_url) return;
+      if(current && current !== this) current.stop();
+      current = this;
+      const a = this.ensureAudio();
+      this.setState(false, true);
+      a.src = this.data.audio_url;
+      try { await a.play(); }
+      catch(e){ this.setState(false, false); console.error("RadioStream widget play:", e); }
+    }
+
+    stop(){
+      if(this.audio){
+        this.audio.pause();
+        this.audio.removeAttribute("src");
+        this.audio.load();
+      }
+      if(current === this) current = null;
+      this.setState(false, false);
+    }
+  }
+
+  customElements.define("radiostream-player", RadioStreamPlayer);
+})();
+"""
+EMBED_JS_VERSION = hashlib.sha1(EMBED_JS.encode()).hexdigest()[:10]
+
 # ---------------- Rutas ----------------
+def _public_cover(cfg):
+    name = cfg.get("cover_filename") or COVER_FILENAME
+    return asset_exists(name), name
+
+def _static_url(name, **kwargs):
+    # el hash en la URL invalida cachés de navegador/CDN al cambiar la imagen
+    return url_for("static", filename=name, v=assets[name]["sha256"][:10], **kwargs)
+
+def public_context(cfg, asset_url=_static_url):
+    """Contexto común de las páginas públicas; asset_url resuelve las imágenes."""
+    cover, cover_filename = _public_cover(cfg)
+    background_filename = cfg.get("background_filename") or BACKGROUND_FILENAME
+    return {
+        "cover": cover,
+        "cover_url": asset_url(cover_filename) if cover else "",
+        "background_enabled": cfg.get("background_enabled", False),
+        "background_url": asset_url(background_filename) if background_exists() else "",
+        "station_label": cfg.get("station_label", ""),
+        "description": cfg.get("description", ""),
+        "audio_url": relay_url() if cfg.get("relay_enabled") else cfg.get("audio_url", ""),
+        "player_buffer": {**PLAYER_BUFFER, **cfg.get("player_buffer", {})},
+        "renditions": rendition_urls(cfg),
+        "theme": {**DEFAULT_THEME, **cfg.get("theme", {})},
+        "theme_css": asset_url(theme_stylesheet(cfg.get("theme"))),
+    }
+
+def station_data(cfg, asset_url):
+    ctx = public_context(cfg, asset_url)
+    theme = ctx["theme"]
+    return {
+        "station_label": ctx["station_label"],
+        "description": ctx["description"],
+        "audio_url": ctx["audio_url"],
+        "cover_url": ctx["cover_url"],
+        "theme": {k: theme[k] for k in ("accent1", "accent2", "text", "muted")},
+    }
+
+def admin_context(cfg):
+    """Valores del formulario de admin que sólo dependen de la config guardada."""
+    theme = cfg.get("theme", DEFAULT_THEME.copy())
+    card_hex = theme.get("card_hex") or ( "#071028" if theme.get("card_bg","").startswith("linear-gradient") else theme.get("card_bg",""))
+    theme_for_admin = {
+        "body_bg": theme.get("body_bg", DEFAULT_THEME["body_bg"]),
+        "card_hex": card_hex,
+        "accent1": theme.get("accent1", DEFAULT_THEME["accent1"]),
+        "text": theme.get("text", DEFAULT_THEME["text"]),
+        "card_bg": theme.get("card_bg", DEFAULT_THEME["card_bg"]),
+        "cover_bg": theme.get("cover_bg", DEFAULT_THEME["cover_bg"]),
+        "muted": theme.get("muted", DEFAULT_THEME["muted"])
+    }
+    theme_for_admin["body_bg_hex"] = theme_for_admin["body_bg"]
+    return {
+        "station_label": cfg.get("station_label", ""),
+        "description": cfg.get("description", ""),
+        "audio_url": cfg.get("audio_url", ""),
+        "port": cfg.get("port", DEFAULT_PORT),
+        "cover": cover_exists(),
+        "cover_filename": COVER_FILENAME,
+        "background_exists": background_exists(),
+        "background_filename": cfg.get("background_filename", BACKGROUND_FILENAME),
+        "background_enabled": cfg.get("background_enabled", False),
+        "theme": theme_for_admin,
+        "schedule_json": json.dumps(cfg.get("schedule", []), indent=2, ensure_ascii=False) if cfg.get("schedule") else "",
+        "schedule_fields": SCHEDULE_FIELDS,
+    }
+
+# Cada sección se construye dentro de la petición (las URLs absolutas dependen
+# del host) la primera vez que se pide, y se guarda hasta que cambie alguna de
+# las claves de las que depende.
+def _build_public():
+    public = public_context(active["config"])
+    return {
+        "index": {
+            "embed_url": url_for("embed", _external=True),
+            "widget_url": url_for("embed_js", v=EMBED_JS_VERSION, _external=True),
+            **public,
+        },
+        "embed": {"force_autoplay": False, **public},
+        "pages": {},
+    }
+
+VIEW_BUILDERS = {
+    "public": _build_public,
+    "station": lambda: json.dumps(station_data(active["config"], lambda name: _static_url(name, _external=True))),
+    "admin": lambda: admin_context(config),
+    "username": lambda: config.get("username"),
+}
+
+def view(section):
+    """Sección precalculada de la vista para el host de la petición."""
+    global _views
+    key = request.host_url
+    value = _views.get(key, {}).get(section)
+    if value is None:
+        epoch = _views_epoch
+        value = VIEW_BUILDERS[section]()
+        with _views_lock:
+            if epoch == _views_epoch:
+                views = _views if key in _views or len(_views) < VIEW_CACHE_HOSTS else {}
+                _views = {**views, key: {**views.get(key, {}), section: value}}
+    return value
+
+def _cached_page(name, **headers):
+    """Devuelve la página pública ya renderizada (con ETag) de la vista actual."""
+    public = view("public")
+    page = public["pages"].get(name)
+    if page is None:
+        body = render_template(TEMPLATES[name], **public[name]).encode("utf-8")
+        page = public["pages"][name] = (body, hashlib.sha1(body).hexdigest())
+    body, etag = page
+    resp = app.response_class(body, mimetype="text/html")
+    resp.headers.update(headers)
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
 @app.route("/")
 def index():
-    cover = cover_exists()
-    bg_exists = background_exists()
-    theme = config.get("theme", DEFAULT_THEME)
-    embed_url = url_for("embed", _external=True)
-    return render_template_string(
-        INDEX_HTML,
-        cover=cover,
-        cover_filename=COVER_FILENAME,
-        background_enabled=config.get("background_enabled", False),
-        background_filename=config.get("background_filename", BACKGROUND_FILENAME) if config.get("background_filename") else BACKGROUND_FILENAME,
-        background_exists=bg_exists,
-        station_label=config.get("station_label", ""),
-        description=config.get("description", ""),
-        audio_url=config.get("audio_url", ""),
-        theme=theme,
-        embed_url=embed_url
-    )
+    return _cached_page("index")
 
 @app.route("/embed")
 def embed():
     """Página ligera pensada para incluir en un iframe. Soporta ?autoplay=1"""
-    cover = cover_exists()
-    theme = config.get("theme", DEFAULT_THEME)
-    return render_template_string(
-        EMBED_HTML,
-        cover=cover,
-        cover_filename=COVER_FILENAME,
-        station_label=config.get("station_label", ""),
-        description=config.get("description", ""),
-        audio_url=config.get("audio_url", ""),
-        theme=theme
-    )
+    return _cached_page("embed")
+
+@app.route("/api/station.json")
+def station_json():
+    """Datos públicos de la emisora para el widget (pequeños y cacheables)."""
+    resp = app.response_class(view("station"), mimetype="application/json")
+    resp.headers["Cache-Control"] = "public, max-age=30"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+@app.route("/embed.js")
+def embed_js():
+    resp = app.response_class(EMBED_JS, mimetype="application/javascript")
+    if request.args.get("v") == EMBED_JS_VERSION:
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        resp.headers["Cache-Control"] = "public, max-age=3600"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.set_etag(EMBED_JS_VERSION)
+    return resp.make_conditional(request)
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -631,7 +1675,7 @@ def login():
         p = request.form.get("password", "")
         cfg_user = config.get("username", "admin")
         cfg_hash = config.get("password_hash", "")
-        if u == cfg_user and check_password_hash(cfg_hash, p):
+        if u == cfg_user and check_password(cfg_hash, p):
             session["user"] = u
             flash("Acceso concedido. Bienvenido 😀")
             next_page = request.args.get("next")
@@ -639,12 +1683,7 @@ def login():
         else:
             flash("Usuario o contraseña incorrectos.")
             return redirect(url_for("login"))
-    # simple login template
-    return render_template_string("""
-<!doctype html><html lang="es"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Login</title>
-<style>body{font-family:system-ui;background:#071022;color:#dbeafe;display:flex;align-items:center;justify-content:center;height:100vh;margin:0}.box{background:#0b1726;padding:28px;border-radius:12px;width:360px}</style>
-</head><body><div class="box"><h2>Admin Login 🔐</h2>{% with messages = get_flashed_messages() %}{% if messages %}<div style="background:#042f2a;padding:8px;border-radius:8px;margin-bottom:10px;color:#b3f0df">{{ messages[0] }}</div>{% endif %}{% endwith %}<form method="post"><label>Usuario</label><input name="username" required style="width:100%;padding:8px;margin:6px 0"><label>Contraseña</label><input name="password" type="password" required style="width:100%;padding:8px;margin:6px 0"><button style="width:100%;padding:10px;margin-top:8px;background:#065f46;color:white;border:none;border-radius:8px">Entrar</button></form></div></body></html>
-""")
+    return render_template(TEMPLATES["login"])
 
 @app.route("/logout")
 def logout():
@@ -652,6 +1691,13 @@ def logout():
     flash("Sesión cerrada.")
     return redirect(url_for("login"))
 
+# Login template (simple)
+LOGIN_HTML = """
+<!doctype html><html lang="es"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Login</title>
+<style>body{font-family:system-ui;background:#071022;color:#dbeafe;display:flex;align-items:center;justify-content:center;height:100vh;margin:0}.box{background:#0b1726;padding:28px;border-radius:12px;width:360px}</style>
+</head><body><div class="box"><h2>Admin Login 🔐</h2>{% with messages = get_flashed_messages() %}{% if messages %}<div style="background:#042f2a;padding:8px;border-radius:8px;margin-bottom:10px;color:#b3f0df">{{ messages[0] }}</div>{% endif %}{% endwith %}<form method="post"><label>Usuario</label><input name="username" required style="width:100%;padding:8px;margin:6px 0"><label>Contraseña</label><input name="password" type="password" required style="width:100%;padding:8px;margin:6px 0"><button style="width:100%;padding:10px;margin-top:8px;background:#065f46;color:white;border:none;border-radius:8px">Entrar</button></form></div></body></html>
+"""
+
 # Admin template (compacto) - añade preview en tiempo real a la derecha
 ADMIN_HTML = """
 <!doctype html><html lang="es"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Admin — RadioStream</title>
@@ -672,6 +1718,7 @@ ADMIN_HTML = """
 <div class="wrap">
   <h1>Panel de administración ⚙️ — RadioStream</h1>
   {% with messages = get_flashed_messages() %}{% if messages %}<div style="background:#042f2a;padding:8px;border-radius:8px;margin-bottom:10px;color:#b3f0df">{{ messages[0] }}</div>{% endif %}{% endwith %}
+  {% if analysis and analysis.silence %}<div style="background:#7f1d1d;padding:8px;border-radius:8px;margin-bottom:10px;color:#fee2e2">⚠️ Silencio en antena desde las {{ analysis.silent_since|fecha }}</div>{% endif %}
 
   <form method="post" enctype="multipart/form-data" style="margin-top:12px">
     <div class="admin-grid">
@@ -679,19 +1726,21 @@ ADMIN_HTML = """
         <label>Label de la emisora</label><input id="fieldStation" name="station_label" value="{{ station_label|e }}" required>
         <label>Descripción (pequeña)</label><textarea id="fieldDesc" name="description">{{ description|e }}</textarea>
         <label>URL online del audio (stream)</label><input id="fieldAudio" name="audio_url" value="{{ audio_url|e }}" placeholder="https://...">
-        <label>Cambiar puerto (reinicia para aplicar)</label><input name="port" value="{{ port }}" pattern="\\d*">
+        <label>Cambiar puerto (recarga el servicio para aplicar)</label><input name="port" value="{{ port }}" pattern="\\d*">
+        <label>Programación (JSON, vacío = sin franjas)</label><textarea name="schedule" placeholder='[{"name": "Mañanas", "days": [0,1,2,3,4], "start": "07:00", "end": "10:00", "overrides": {"station_label": "Buenos días", "audio_url": "https://..."}}]' style="font-family:monospace;min-height:90px">{{ schedule_json }}</textarea>
+        <div class="small-muted">Ahora en antena: <strong>{{ on_air or "programación base" }}</strong>. Campos programables: {{ schedule_fields|join(", ") }}. Días: 0 = lunes.</div>
         <hr style="margin:12px 0;border:none;border-top:1px solid rgba(255,255,255,0.04)">
         <label>Nuevo usuario (vacío = no cambiar)</label><input name="new_user" placeholder="nuevo usuario">
         <label>Nueva contraseña (vacío = no cambiar)</label><input name="new_pass" type="password" placeholder="nueva contraseña">
         <div style="margin-top:12px;"><button class="btn-save" type="submit">💾 Guardar cambios</button>
         <button name="restore_colors" value="1" style="margin-left:8px;background:#111827;color:#fff;padding:10px;border-radius:8px;border:none">🎨 Restaurar colores</button></div>
-        <div style="margin-top:8px;color:#9fb3cf">Al cambiar el puerto reinicia el servidor para aplicar.</div>
+        <div style="margin-top:8px;color:#9fb3cf">Al cambiar el puerto recarga el servicio (SIGHUP) para aplicar sin cortes.</div>
       </div>
 
       <div>
         <!-- Live preview -->
         <div class="right-card">
-          <div class="small-muted">Vista previa en tiempo real (antes de guardar)</div>
+          <div class="small-muted">Vista previa en tiempo real; textos, colores y casillas se guardan al cambiar <span id="saveState"></span></div>
           <div id="adminPreview" class="live-preview" role="region" aria-label="Vista previa">
             <div id="previewBg" style="border-radius:8px;padding:8px;background-size:cover;background-position:center;">
               <div class="cover" id="previewCoverContainer">
@@ -735,10 +1784,52 @@ ADMIN_HTML = """
             <input id="textColor" type="color" name="text" value="{{ theme.text }}" style="width:46px;height:34px">
           </div>
           <div style="margin-top:12px;color:#9fb3cf">Puerto actual: <strong>{{ port }}</strong></div>
+          <hr style="margin:10px 0;border:none;border-top:1px solid rgba(255,255,255,0.04)">
+          <div style="display:flex;gap:8px;align-items:center"><label style="color:#9fb3cf">Detectar silencio</label><input id="analysisEnabled" type="checkbox" name="analysis_enabled" value="1" {% if analysis %}checked{% endif %} style="width:auto">
+            {% if analysis %}<span class="small-muted" style="margin:0 0 0 auto">Nivel: {{ "%.1f"|format(analysis.loudness_db) if analysis.loudness_db is not none else "—" }} dBFS · {{ analysis.decoder or "esperando" }}</span>{% endif %}</div>
+          <div style="display:flex;gap:8px;align-items:center"><label style="color:#9fb3cf">Relay con arranque rápido (/stream)</label><input id="relayEnabled" type="checkbox" name="relay_enabled" value="1" {% if relay %}checked{% endif %} style="width:auto">
+            {% if relay %}<span class="small-muted" style="margin:0 0 0 auto">{{ relay.clients }} oyentes · {{ relay.ring_seconds }} s / {{ (relay.ring_bytes / 1048576)|round(1) }} MB en memoria{% if relay.slow_disconnects %} · {{ relay.slow_disconnects }} desconectados por lentos{% endif %}</span>{% endif %}</div>
+          <div style="display:flex;gap:8px;align-items:center"><label style="color:#9fb3cf">Transcodificar (escalera de bitrates)</label><input id="transcodeEnabled" type="checkbox" name="transcode_enabled" value="1" {% if transcode %}checked{% endif %} style="width:auto">
+            {% if transcode %}<span class="small-muted" style="margin:0 0 0 auto">{% for name, r in transcode.renditions.items() %}{{ name }}: {{ r.clients }}{% if not r.encoder %} ⚠️{% endif %}{% if not loop.last %} · {% endif %}{% endfor %}</span>{% endif %}</div>
+          <div style="display:flex;gap:8px;align-items:center"><label style="color:#9fb3cf">Grabar emisión (air-check)</label><input id="recorderEnabled" type="checkbox" name="recorder_enabled" value="1" {% if recorder_enabled %}checked{% endif %} style="width:auto"></div>
+          {% if recordings %}
+            {% for r in recordings %}
+              <div class="small-muted"><a href="{{ url_for('admin_recording_file', name=r.file) }}" style="color:#9fb3cf">{{ r.start|fecha }} → {{ r.end|fecha }}</a> · {{ (r.size / 1048576)|round(1) }} MB</div>
+            {% endfor %}
+            <div class="small-muted" style="display:flex;gap:6px;align-items:center;margin-top:6px">
+              <input form="rangeForm" type="datetime-local" name="from" required style="padding:4px">
+              <input form="rangeForm" type="datetime-local" name="to" required style="padding:4px">
+              <button form="rangeForm" style="background:#111827;color:#fff;padding:4px 8px;border-radius:6px;border:none">⬇ Rango</button>
+            </div>
+          {% endif %}
+          {% if qoe_rows %}
+          <hr style="margin:10px 0;border:none;border-top:1px solid rgba(255,255,255,0.04)">
+          <label>Calidad de escucha (por web que embebe)</label>
+          <table class="small-muted" style="width:100%;border-collapse:collapse">
+            <tr><th align="left">Host</th><th>Lotes</th><th>1er audio p50/p90 (≤ ms)</th><th>Cortes</th><th>Errores</th></tr>
+            {% for host, q in qoe_rows %}
+            <tr><td>{{ host }}</td><td align="center">{{ q.beacons }}</td>
+                <td align="center">{% if q.ttfa_n %}{{ q.ttfa_p50 }} / {{ q.ttfa_p90 }}{% else %}—{% endif %}</td>
+                <td align="center">{{ q.stalls }}</td><td align="center">{{ q.errors.values()|sum }}</td></tr>
+            {% endfor %}
+          </table>
+          {% endif %}
+          {% if history %}
+          <hr style="margin:10px 0;border:none;border-top:1px solid rgba(255,255,255,0.04)">
+          <label>Historial de cambios</label>
+          {% for h in history %}
+            <div class="small-muted" style="display:flex;gap:8px;align-items:center">
+              <span>#{{ h.seq }} · {{ h.ts|fecha }} · {{ h.who or "—" }} · {{ (h.set.keys()|list + h.unset)|join(", ") }}</span>
+              <button form="rollbackForm" name="seq" value="{{ h.seq - 1 }}" style="margin-left:auto;background:#111827;color:#fff;padding:4px 8px;border-radius:6px;border:none">↶ Deshacer</button>
+            </div>
+          {% endfor %}
+          {% endif %}
         </div>
       </div>
     </div>
   </form>
+  <form id="rollbackForm" method="post" action="{{ url_for('admin_rollback') }}"></form>
+  <form id="rangeForm" method="get" action="{{ url_for('admin_recording_range') }}"></form>
 </div>
 
 <!-- Live preview script: actualiza vista previa según cambios en inputs (sin guardar) -->
@@ -858,6 +1949,40 @@ ADMIN_HTML = """
     });
   });
 
+  // guardado al vuelo: cada cambio viaja solo por PATCH (sin recargar la página)
+  const saveState = document.getElementById("saveState");
+  let pending = {}, saveTimer = null;
+  function queuePatch(key, value){
+    pending[key] = key === "theme" ? Object.assign(pending.theme || {}, value) : value;
+    clearTimeout(saveTimer);
+    saveTimer = setTimeout(sendPatch, 300);
+  }
+  function sendPatch(){
+    const body = pending;
+    pending = {};
+    saveState.textContent = "· guardando…";
+    fetch("{{ url_for('admin_patch_config') }}", {
+      method: "PATCH", credentials: "same-origin",
+      headers: {"Content-Type": "application/json"}, body: JSON.stringify(body)
+    }).then((r) => r.json().then((d) => ({ok: r.ok, d: d})))
+      .then((res) => {
+        saveState.textContent = res.ok ? (res.d.changed.length ? "· guardado ✓" : "· sin cambios") : "· ⚠️ " + res.d.error;
+      })
+      .catch(() => { saveState.textContent = "· ⚠️ no se pudo guardar; usa «Guardar»"; });
+  }
+  fieldStation.addEventListener("change", () => { if(fieldStation.value.trim()) queuePatch("station_label", fieldStation.value); });
+  fieldDesc.addEventListener("change", () => queuePatch("description", fieldDesc.value));
+  fieldAudio.addEventListener("change", () => queuePatch("audio_url", fieldAudio.value));
+  [[bodyColor, "body_bg"], [cardColor, "card_bg"], [accentColor, "accent1"], [textColor, "text"]].forEach(([el, key]) => {
+    el.addEventListener("change", () => queuePatch("theme", {[key]: el.value}));
+  });
+  // con un fichero elegido el background se activa al enviar el formulario
+  bgEnabled.addEventListener("change", () => { if(!bgFile.value) queuePatch("background_enabled", bgEnabled.checked); });
+  [["analysisEnabled", "analysis_enabled"], ["recorderEnabled", "recorder_enabled"], ["relayEnabled", "relay_enabled"], ["transcodeEnabled", "transcode_enabled"]].forEach(([id, key]) => {
+    const el = document.getElementById(id);
+    el.addEventListener("change", () => queuePatch(key, el.checked));
+  });
+
   // si al cargar no hay cover, mantener placeholder visible
   if(!document.getElementById("previewCover")){
     if(previewNoCover) previewNoCover.style.display = "";
@@ -876,20 +2001,20 @@ def admin():
     if request.method == "POST":
         if request.form.get("restore_colors"):
             config["theme"] = DEFAULT_THEME.copy()
-            save_config(config)
+            save_config(config, actor=session.get("user"))
             flash("Colores restaurados a los valores por defecto 🎨")
             return redirect(url_for("admin"))
 
         if request.form.get("remove_background"):
             try:
-                p = STATIC_DIR / BACKGROUND_FILENAME
-                if p.exists():
-                    p.unlink()
+                (STATIC_DIR / BACKGROUND_FILENAME).unlink(missing_ok=True)
             except Exception as e:
                 app.logger.debug("No se pudo borrar background: %s", e)
+            forget_asset(BACKGROUND_FILENAME)
+            schedule_static_export()
             config["background_enabled"] = False
             config["background_filename"] = ""
-            save_config(config)
+            save_config(config, actor=session.get("user"))
             flash("Background eliminado y desactivado.")
             return redirect(url_for("admin"))
 
@@ -907,6 +2032,19 @@ def admin():
 
         background_enabled = True if request.form.get("background_enabled") else False
 
+        try:
+            validate_theme({k: v for k, v in (("body_bg", body_bg), ("card_bg", card_bg_hex),
+                                                ("accent1", accent1), ("text", text_color)) if v})
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for("admin"))
+
+        try:
+            schedule = parse_schedule(request.form.get("schedule", ""))
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for("admin"))
+
         if port:
             try:
                 port_int = int(port)
@@ -922,10 +2060,13 @@ def admin():
         # cover
         file = request.files.get("cover_file")
         if file and file.filename:
+            from werkzeug.utils import secure_filename
             filename = secure_filename(file.filename)
             if allowed_file(filename):
                 save_path = STATIC_DIR / COVER_FILENAME
                 file.save(save_path)
+                register_asset(COVER_FILENAME)
+                schedule_static_export()
                 flash("Imagen cover subida correctamente.")
             else:
                 flash("Tipo de archivo no permitido para la imagen de cover.")
@@ -934,10 +2075,13 @@ def admin():
         # background
         bfile = request.files.get("background_file")
         if bfile and bfile.filename:
+            from werkzeug.utils import secure_filename
             bf = secure_filename(bfile.filename)
             if allowed_file(bf):
                 save_path = STATIC_DIR / BACKGROUND_FILENAME
                 bfile.save(save_path)
+                register_asset(BACKGROUND_FILENAME)
+                schedule_static_export()
                 config["background_filename"] = BACKGROUND_FILENAME
                 flash("Imagen de background subida correctamente.")
             else:
@@ -955,7 +2099,7 @@ def admin():
             config["username"] = new_user
             session["user"] = new_user
         if new_pass:
-            config["password_hash"] = generate_password_hash(new_pass)
+            config["password_hash"] = hash_password(new_pass)
 
         theme = config.get("theme", DEFAULT_THEME.copy())
         if body_bg:
@@ -969,6 +2113,11 @@ def admin():
             theme["text"] = text_color
 
         config["theme"] = theme
+        config["schedule"] = schedule
+        config["recorder_enabled"] = bool(request.form.get("recorder_enabled"))
+        config["relay_enabled"] = bool(request.form.get("relay_enabled"))
+        config["transcode_enabled"] = bool(request.form.get("transcode_enabled"))
+        config["analysis_enabled"] = bool(request.form.get("analysis_enabled"))
         config["background_enabled"] = bool(background_enabled)
         if config["background_enabled"] and not background_exists():
             config["background_enabled"] = False
@@ -978,51 +2127,1982 @@ def admin():
             config["secret_key"] = secrets.token_hex(32)
             app.secret_key = config["secret_key"]
 
-        save_config(config)
+        save_config(config, actor=session.get("user"))
         if changed_port:
-            flash(f"Configuración guardada. Puerto cambiado a {port_int}. Reinicia el servidor para aplicar el nuevo puerto.")
+            flash(f"Configuración guardada. Puerto cambiado a {port_int}. Recarga el servicio (systemctl reload radiostream o SIGHUP) para aplicar el nuevo puerto.")
         else:
             flash("Configuración guardada correctamente.")
         return redirect(url_for("admin"))
 
-    theme = config.get("theme", DEFAULT_THEME.copy())
-    card_hex = theme.get("card_hex") or ( "#071028" if theme.get("card_bg","").startswith("linear-gradient") else theme.get("card_bg",""))
-    theme_for_admin = {
-        "body_bg": theme.get("body_bg", DEFAULT_THEME["body_bg"]),
-        "card_hex": card_hex,
-        "accent1": theme.get("accent1", DEFAULT_THEME["accent1"]),
-        "text": theme.get("text", DEFAULT_THEME["text"]),
-        "card_bg": theme.get("card_bg", DEFAULT_THEME["card_bg"]),
-        "cover_bg": theme.get("cover_bg", DEFAULT_THEME["cover_bg"]),
-        "muted": theme.get("muted", DEFAULT_THEME["muted"])
-    }
-    theme_for_admin["body_bg_hex"] = theme_for_admin["body_bg"]
-    theme_for_admin["accent1"] = theme_for_admin["accent1"]
-    theme_for_admin["text"] = theme_for_admin["text"]
-
-    return render_template_string(
-        ADMIN_HTML,
+    return render_template(
+        TEMPLATES["admin"],
         current_user=session.get("user"),
-        station_label=config.get("station_label", ""),
-        description=config.get("description", ""),
-        audio_url=config.get("audio_url", ""),
-        port=config.get("port", DEFAULT_PORT),
-        cover=cover_exists(),
-        cover_filename=COVER_FILENAME,
-        background_exists=background_exists(),
-        background_filename=config.get("background_filename", BACKGROUND_FILENAME),
-        background_enabled=config.get("background_enabled", False),
-        theme=theme_for_admin
+        **view("admin"),
+        on_air=(active["slot"] or {}).get("name"),
+        recorder_enabled=config.get("recorder_enabled", False),
+        relay=relay.status() if relay.running else None,
+        transcode=transcoder.status() if transcoder else None,
+        analysis=analyzer.status() if analyzer else None,
+        qoe_rows=qoe_summary()["host"][:10],
+        recordings=list(reversed(recorder.segments[-10:])) if recorder else [],
+        history=config_history(10)
     )
 
+@app.route("/admin/history")
+@login_required
+def admin_history():
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return jsonify({"error": "Parámetro limit inválido."}), 400
+    return jsonify(config_history(min(max(limit, 1), JOURNAL_KEEP)))
+
+@app.route("/admin/rollback", methods=["POST"])
+@login_required
+def admin_rollback():
+    try:
+        seq = int(request.form.get("seq", ""))
+    except ValueError:
+        flash("Cambio inválido.")
+        return redirect(url_for("admin"))
+    try:
+        if rollback_config(config, seq, actor=session.get("user")):
+            flash(f"Configuración devuelta al estado #{seq}.")
+        else:
+            flash("No hay cambios que deshacer.")
+    except ValueError as e:
+        flash(str(e))
+    if session.get("user") != config.get("username"):
+        session["user"] = config.get("username")
+    return redirect(url_for("admin"))
+
+# ---------------- API de cambios parciales ----------------
+# El panel guarda cada campo al vuelo con PATCH {"campo": valor}; sólo se
+# valida, registra en el journal e invalida lo que viene en el cuerpo.
+THEME_FIELDS = ("body_bg", "card_bg", "accent1", "text")
+
+def _text(value, required=False):
+    if not isinstance(value, str):
+        raise ValueError("Se esperaba un texto.")
+    value = value.strip()
+    if required and not value:
+        raise ValueError("El campo no puede estar vacío.")
+    return value
+
+def _patch_theme(value):
+    if not isinstance(value, dict) or set(value) - set(THEME_FIELDS):
+        raise ValueError(f"Tema inválido; campos permitidos: {', '.join(THEME_FIELDS)}.")
+    theme = {**config.get("theme", DEFAULT_THEME), **validate_theme(value)}
+    if "card_bg" in value:
+        theme["card_hex"] = theme["card_bg"]
+    return theme
+
+def _patch_port(value):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError("Puerto inválido.")
+    try:
+        port = int(value)
+    except ValueError:
+        raise ValueError("Puerto inválido.")
+    if not (1 <= port <= 65535):
+        raise ValueError("Puerto fuera de rango (1-65535).")
+    return port
+
+def _patch_background(value):
+    if not isinstance(value, bool):
+        raise ValueError("Se esperaba true o false.")
+    if value and not background_exists():
+        raise ValueError("No hay imagen de background subida.")
+    return value
+
+def _flag(value):
+    if not isinstance(value, bool):
+        raise ValueError("Se esperaba true o false.")
+    return value
+
+PATCH_FIELDS = {
+    "station_label": lambda v: _text(v, required=True),
+    "description": _text,
+    "audio_url": _text,
+    "port": _patch_port,
+    "theme": _patch_theme,
+    "background_enabled": _patch_background,
+    "recorder_enabled": _flag,
+    "relay_enabled": _flag,
+    "transcode_enabled": _flag,
+    "analysis_enabled": _flag,
+    "schedule": lambda v: parse_schedule(json.dumps(v)),
+}
+
+@app.route("/admin/api/config", methods=["PATCH"])
+@login_required
+def admin_patch_config():
+    """Aplica un cambio parcial; responde con las claves que han cambiado de verdad."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data:
+        return jsonify({"error": "Se esperaba un objeto JSON con los campos a cambiar."}), 400
+    unknown = sorted(set(data) - set(PATCH_FIELDS))
+    if unknown:
+        return jsonify({"error": f"Campos no editables: {', '.join(unknown)}."}), 400
+    updates = {}
+    for key, value in data.items():
+        try:
+            updates[key] = PATCH_FIELDS[key](value)
+        except ValueError as e:
+            return jsonify({"error": str(e), "field": key}), 400
+    changed = sorted(k for k, v in updates.items() if config.get(k) != v)
+    if changed:
+        config.update({k: updates[k] for k in changed})
+        save_config(config, actor=session.get("user"))
+    return jsonify({"changed": changed, "on_air": (active["slot"] or {}).get("name")})
+
+# ---------------- Toma del stream de origen ----------------
+# Una única conexión a audio_url cuyo contenido se reparte a los consumidores
+# internos (grabador, análisis, relay...). Sólo está abierta mientras haya
+# alguno suscrito y sigue a la URL efectiva (incluida la programación).
+UPSTREAM_CHUNK = 64 * 1024
+UPSTREAM_TIMEOUT = 10
+UPSTREAM_RETRY = 3
+
+def _wav_header(data):
+    """Bytes de cabecera RIFF/WAVE hasta el inicio del chunk 'data' (o b"")."""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return b""
+    pos = 12
+    while pos + 8 <= len(data):
+        cid, size = data[pos:pos + 4], int.from_bytes(data[pos + 4:pos + 8], "little")
+        if cid == b"data":
+            return data[:pos + 8]
+        pos += 8 + size + (size & 1)
+    return b""
+
+class UpstreamTap:
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self.url = ""
+        self.header = b""        # cabecera del formato (WAV) para quien empiece a mitad
+        self.content_type = ""
+        self.connected = False
+        self.connections = 0     # cambia en cada reconexión al origen
+        self.bytes_total = 0
+
+    def subscribe(self, fn):
+        with self._lock:
+            self._subscribers.append(fn)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="upstream", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, fn):
+        with self._lock:
+            if fn in self._subscribers:
+                self._subscribers.remove(fn)
+
+    def _publish(self, data, now):
+        for fn in list(self._subscribers):
+            try:
+                fn(data, now)
+            except Exception:
+                app.logger.exception("Error en consumidor del stream")
+
+    def _run(self):
+        from urllib.request import Request, urlopen
+        while self._subscribers and not shutting_down.is_set():
+            url = active["config"].get("audio_url", "")
+            if not url:
+                shutting_down.wait(UPSTREAM_RETRY)
+                continue
+            try:
+                req = Request(url, headers={"User-Agent": "RadioStream", "Icy-MetaData": "0"})
+                with urlopen(req, timeout=UPSTREAM_TIMEOUT) as resp:
+                    self.url = url
+                    self.content_type = resp.headers.get("Content-Type", "application/octet-stream")
+                    self.header = b""
+                    self.connected = True
+                    self.connections += 1
+                    first = True
+                    while self._subscribers and not shutting_down.is_set():
+                        data = resp.read1(UPSTREAM_CHUNK)
+                        if not data:
+                            break
+                        if first:
+                            # la cabecera se guarda aparte; los consumidores sólo reciben audio
+                            self.header = _wav_header(data)
+                            data = data[len(self.header):]
+                            first = False
+                        if data:
+                            self.bytes_total += len(data)
+                            self._publish(data, time.time())
+                        if active["config"].get("audio_url", "") != url:
+                            break  # cambio de URL (admin o programación)
+            except OSError as e:
+                app.logger.warning("Stream de origen no disponible (%s): %s", url, e)
+            self.connected = False
+            if self._subscribers:
+                shutting_down.wait(UPSTREAM_RETRY)
+
+upstream = UpstreamTap()
+
+# ---------------- Núcleo de streaming: anillo compartido y oyentes lentos ----------------
+# Cada chunk del origen se guarda una sola vez en un anillo acotado; cada
+# conexión sólo tiene un cursor (número de secuencia) dentro de él, así que su
+# "cola" son referencias y no copias. Si un oyente se queda más de
+# queue_chunks por detrás se le salta al directo; si en skip_window segundos
+# necesita más de max_skips saltos, se le desconecta (max_skips=0: desconectar
+# a la primera). La memoria total la acota el anillo, no el número de oyentes.
+STREAM_QUEUE_CHUNKS = 64
+STREAM_MAX_SKIPS = 3
+STREAM_SKIP_WINDOW = 60
+STREAM_MAX_BYTES = 8 * 1024 * 1024   # tope del anillo, pase lo que pase
+
+class StreamClient:
+    def __init__(self, hub, seq, addr=""):
+        self.hub = hub
+        self.seq = seq
+        self.addr = addr
+        self.connected_at = time.time()
+        self.sent_bytes = 0
+        self.skips = 0
+        self.closed = None          # motivo del cierre
+        self._skip_times = deque()
+        self._realign = True
+
+    def _skip(self, now):
+        hub = self.hub
+        self.skips += 1
+        hub.skips_total += 1
+        self._skip_times.append(now)
+        while self._skip_times and self._skip_times[0] < now - hub.skip_window:
+            self._skip_times.popleft()
+        if len(self._skip_times) > hub.max_skips:
+            self.closed = "lento"
+            hub.slow_disconnects += 1
+            hub.clients.discard(self)
+            return False
+        self.seq = hub.next_seq - 1   # al chunk más reciente
+        self._realign = True
+        return True
+
+    def read(self, timeout=1.0):
+        """Siguiente chunk; b"" si no llegó nada en `timeout`, None si está cerrado."""
+        hub = self.hub
+        with hub.cond:
+            if self.closed:
+                return None
+            if self.seq >= hub.next_seq:
+                hub.cond.wait(timeout)
+                if self.closed:
+                    return None
+                if self.seq >= hub.next_seq:
+                    return b""
+            first = hub.ring[0][0]
+            if (self.seq < first or hub.next_seq - self.seq > hub.queue_chunks) and not self._skip(time.time()):
+                return None
+            _, _, offset, data = hub.ring[self.seq - first]
+            self.seq += 1
+            if self._realign:
+                # tras conectar o saltar, el primer chunk empieza en frontera de muestra
+                self._realign = False
+                data = data[(-offset) % hub.align:]
+        self.sent_bytes += len(data)
+        return data
+
+    def pinned_bytes(self):
+        """Bytes en la cola de este oyente: referencias al anillo, no copias."""
+        hub = self.hub
+        if not hub.ring or self.seq >= hub.next_seq:
+            return 0
+        first = hub.ring[0][0]
+        # lo que quede por detrás de su cola se saltará en la próxima lectura
+        return hub.offset - hub.ring[max(self.seq, first, hub.next_seq - hub.queue_chunks) - first][2]
+
+    def close(self, reason="cerrado"):
+        with self.hub.cond:
+            if not self.closed:
+                self.closed = reason
+            self.hub.clients.discard(self)
+            self.hub.cond.notify_all()
+
+class StreamHub:
+    def __init__(self, burst_seconds=0, queue_chunks=STREAM_QUEUE_CHUNKS, max_skips=STREAM_MAX_SKIPS,
+                 skip_window=STREAM_SKIP_WINDOW, max_bytes=STREAM_MAX_BYTES):
+        self.cond = threading.Condition()
+        self.ring = deque()         # (seq, instante, offset, datos)
+        self.ring_bytes = 0
+        self.next_seq = 0
+        self.offset = 0
+        self.align = 1              # tamaño de muestra en PCM; 1 para formatos comprimidos
+        self.clients = set()
+        self.skips_total = 0
+        self.slow_disconnects = 0
+        self.configure(burst_seconds, queue_chunks, max_skips, skip_window, max_bytes)
+
+    def configure(self, burst_seconds=0, queue_chunks=STREAM_QUEUE_CHUNKS, max_skips=STREAM_MAX_SKIPS,
+                  skip_window=STREAM_SKIP_WINDOW, max_bytes=STREAM_MAX_BYTES):
+        self.burst_seconds = burst_seconds
+        self.queue_chunks = max(1, queue_chunks)
+        self.max_skips = max_skips
+        self.skip_window = skip_window
+        self.max_bytes = max_bytes
+
+    def publish(self, data, now):
+        with self.cond:
+            self.ring.append((self.next_seq, now, self.offset, data))
+            self.next_seq += 1
+            self.offset += len(data)
+            self.ring_bytes += len(data)
+            while len(self.ring) > 1 and (self.ring_bytes > self.max_bytes or (
+                    len(self.ring) > self.queue_chunks and self.ring[0][1] < now - self.burst_seconds)):
+                self.ring_bytes -= len(self.ring.popleft()[3])
+            self.cond.notify_all()
+
+    def reset(self, align=1):
+        """Empieza un stream nuevo (p. ej. reconexión al origen) sin penalizar a nadie."""
+        with self.cond:
+            self.ring.clear()
+            self.ring_bytes = 0
+            self.offset = 0
+            self.align = align
+            for client in self.clients:
+                client.seq = self.next_seq
+                client._realign = True
+
+    def connect(self, addr="", burst=True):
+        with self.cond:
+            seq = self.next_seq
+            if burst and self.ring:
+                since = time.time() - self.burst_seconds
+                seq = next((entry[0] for entry in self.ring if entry[1] >= since), self.next_seq)
+                seq = max(seq, self.next_seq - self.queue_chunks)
+            client = StreamClient(self, seq, addr)
+            self.clients.add(client)
+        return client
+
+    def close_all(self, reason="cerrado"):
+        with self.cond:
+            for client in list(self.clients):
+                client.closed = reason
+            self.clients.clear()
+            self.cond.notify_all()
+
+    def stats(self, top=10):
+        with self.cond:
+            clients = [(c, c.pinned_bytes()) for c in self.clients]
+            ring_seconds = self.ring[-1][1] - self.ring[0][1] if self.ring else 0
+            stats = {
+                "clients": len(clients),
+                "ring_chunks": len(self.ring),
+                "ring_bytes": self.ring_bytes,
+                "ring_seconds": round(ring_seconds, 1),
+                "pinned_bytes": sum(p for _, p in clients),
+                "skips": self.skips_total,
+                "slow_disconnects": self.slow_disconnects,
+            }
+        clients.sort(key=lambda cp: cp[1], reverse=True)
+        stats["top"] = [{"addr": c.addr, "pinned_bytes": p, "lag_chunks": max(0, self.next_seq - c.seq),
+                         "sent_bytes": c.sent_bytes, "skips": c.skips,
+                         "age": round(time.time() - c.connected_at)} for c, p in clients[:top]]
+        return stats
+
+def _rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def bench_stream(clients=2000, seconds=20, chunk_bytes=16 * 1024, chunks_per_second=32):
+    """Estrés del núcleo: muchos lectores lentos simulados contra un productor
+    a ritmo fijo. Imprime el RSS cada segundo junto a lo que ocuparían colas
+    por cliente sin límite (todo lo publicado y aún no leído)."""
+    import random
+    import statistics
+
+    hub = StreamHub(RELAY_BURST_SECONDS)
+    stop = threading.Event()
+    # un tercio lee al ritmo, un tercio a la mitad y el resto casi nunca (redes móviles atascadas)
+    speeds = [1.0, 0.5, 0.02]
+    readers = []
+
+    def connect(speed):
+        client = hub.connect(burst=True)
+        client.start_offset = hub.offset
+        client.speed = speed
+        client.consumed = 0
+        return client
+
+    def producer():
+        i = 0
+        while not stop.wait(1 / chunks_per_second):
+            hub.publish(bytes([i % 256]) * chunk_bytes, time.time())
+            i += 1
+
+    def reader(slot):
+        tick = 0.1
+        while not stop.wait(tick):
+            for n, client in enumerate(readers[slot]):
+                if client.closed:
+                    readers[slot][n] = connect(client.speed)   # el reproductor reconecta
+                    continue
+                budget = client.speed * chunks_per_second * tick
+                reads = int(budget) + (random.random() < budget % 1)
+                for _ in range(reads):
+                    data = client.read(timeout=0)
+                    if not data:
+                        break
+                    client.consumed += len(data)
+
+    workers = 8
+    for slot in range(workers):
+        readers.append([connect(speeds[(slot + i * workers) % 3]) for i in range(slot, clients, workers)])
+    threads = [threading.Thread(target=producer, daemon=True)]
+    threads += [threading.Thread(target=reader, args=(slot,), daemon=True) for slot in range(workers)]
+    for t in threads:
+        t.start()
+
+    mb = 1024 * 1024
+    samples = []
+    print(f"{clients} lectores, {chunk_bytes // 1024} KiB x {chunks_per_second}/s; cola {hub.queue_chunks} chunks, "
+          f"{hub.max_skips} saltos antes de desconectar")
+    print("  s   RSS MB  anillo MB  en colas MB  saltos  desconex.  sin límite MB")
+    try:
+        for second in range(1, seconds + 1):
+            time.sleep(1)
+            st = hub.stats(top=0)
+            unbounded = sum(hub.offset - c.start_offset - c.consumed for slot in readers for c in slot)
+            rss = _rss()
+            samples.append(rss)
+            print(f"{second:3d}  {rss / mb:7.1f}  {st['ring_bytes'] / mb:9.1f}  {st['pinned_bytes'] / mb:11.1f}"
+                  f"  {st['skips']:6d}  {st['slow_disconnects']:9d}  {unbounded / mb:13.1f}")
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    steady = samples[len(samples) // 4:]
+    print(f"RSS estable: mediana {statistics.median(steady) / mb:.1f} MB, "
+          f"variación {(max(steady) - min(steady)) / mb:.1f} MB")
+
+def listen_hub(hub, header=b"", addr=""):
+    """Generador para un oyente: cabecera, ráfaga inicial y después en vivo."""
+    client = hub.connect(addr)
+    try:
+        if header:
+            yield header
+        idle = 0
+        # se despierta cada segundo para cerrar pronto al relevar el proceso
+        while not shutting_down.is_set() and idle < RELAY_IDLE:
+            data = client.read(timeout=1)
+            if data is None:
+                break
+            if not data:
+                idle += 1
+                continue
+            idle = 0
+            yield data
+    finally:
+        client.close()
+
+def stream_response(body, mimetype):
+    resp = app.response_class(body, mimetype=mimetype or "application/octet-stream")
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers["X-Accel-Buffering"] = "no"   # que un nginx delante no acumule la ráfaga
+    return resp
+
+def _unavailable(message):
+    resp = app.response_class(message, status=503, mimetype="text/plain")
+    resp.headers["Retry-After"] = "2"
+    return resp
+
+# ---------------- Relay con arranque rápido ----------------
+# /stream reenvía el stream de origen a los oyentes. Mientras está activado la
+# toma se mantiene abierta y el anillo guarda los últimos segundos de audio:
+# un oyente nuevo los recibe de golpe (el navegador arranca en cuanto llegan,
+# sin esperar a llenar el buffer a ritmo real) y luego sigue en vivo.
+RELAY_BURST_SECONDS = 4
+RELAY_IDLE = 15             # segundos sin datos del origen antes de cerrar
+PLAYER_BUFFER = {"target": 1.5, "max": 6.0}
+
+class Relay:
+    def __init__(self):
+        self.hub = StreamHub(RELAY_BURST_SECONDS)
+        self._connection = None
+        self.running = False
+
+    def start(self, burst_seconds=RELAY_BURST_SECONDS, **policy):
+        self.hub.configure(burst_seconds, **policy)
+        if not self.running:
+            self.running = True
+            upstream.subscribe(self._on_data)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            upstream.unsubscribe(self._on_data)
+            self.hub.close_all("relay desactivado")
+            self.hub.reset()
+
+    def _on_data(self, data, now):
+        if upstream.connections != self._connection:
+            # conexión nueva al origen: el audio anterior ya no sirve de arranque
+            self._connection = upstream.connections
+            fmt = _wav_format(upstream.header) if upstream.header else None
+            self.hub.reset(max(1, fmt[0] * fmt[2] // 8) if fmt else 1)
+        self.hub.publish(data, now)
+
+    def listen(self, addr=""):
+        return listen_hub(self.hub, upstream.header, addr)
+
+    def status(self):
+        return {"running": self.running, "upstream": upstream.connected,
+                "content_type": upstream.content_type, **self.hub.stats()}
+
+relay = Relay()
+
+def relay_url():
+    return url_for("relay_stream", _external=True)
+
+def apply_relay_config():
+    if config.get("relay_enabled"):
+        relay.start(config.get("relay_burst_seconds", RELAY_BURST_SECONDS),
+                    queue_chunks=config.get("stream_queue_chunks", STREAM_QUEUE_CHUNKS),
+                    max_skips=config.get("stream_max_skips", STREAM_MAX_SKIPS))
+    else:
+        relay.stop()
+
+@on_config_change
+def _relay_on_change(keys):
+    if keys & {"relay_enabled", "relay_burst_seconds", "stream_queue_chunks", "stream_max_skips"}:
+        apply_relay_config()
+
+@app.route("/stream")
+def relay_stream():
+    if not relay.running:
+        return "Relay desactivado", 404
+    if not upstream.connected:
+        return _unavailable("Conectando con el origen")
+    return stream_response(relay.listen(request.remote_addr), upstream.content_type)
+
+@app.route("/admin/api/relay")
+@login_required
+def admin_relay():
+    return jsonify(relay.status())
+
+def _read_until(host, port, path, nbytes, timeout=10):
+    """Segundos desde conectar hasta recibir nbytes del cuerpo de la respuesta."""
+    import socket
+    t0 = time.perf_counter()
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        conn.sendall(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+        buf = b""
+        while b"\r\n\r\n" not in buf:
+            chunk = conn.recv(65536)
+            if not chunk:
+                raise RuntimeError(f"{path}: conexión cerrada sin respuesta")
+            buf += chunk
+        status = buf.split(b" ", 2)[1]
+        if status != b"200":
+            raise RuntimeError(f"{path}: HTTP {status.decode()}")
+        got = len(buf) - buf.index(b"\r\n\r\n") - 4
+        while got < nbytes:
+            chunk = conn.recv(65536)
+            if not chunk:
+                raise RuntimeError(f"{path}: el stream se cortó")
+            got += len(chunk)
+    return time.perf_counter() - t0
+
+def bench_ttfa(runs=10, start_seconds=1.0):
+    """Tiempo hasta tener `start_seconds` de audio: origen directo frente al relay.
+
+    Usa el origen de prueba (WAV a ritmo real) y un servidor local en hilos; la
+    config sólo se cambia en memoria."""
+    global active
+    import logging
+    import statistics
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    rate = ANALYSIS_RATE
+    needed = 44 + int(start_seconds * rate * 2)     # cabecera + PCM mono 16 bits
+    origin_port, relay_port = _free_port(), _free_port()
+    origin = serve_tone(origin_port, rate=rate)
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    active = {"slot": None, "config": {**active["config"], "audio_url": f"http://127.0.0.1:{origin_port}/"}}
+    relay.start(RELAY_BURST_SECONDS)
+    server = make_server("127.0.0.1", relay_port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        deadline = time.monotonic() + 10
+        while relay.status()["ring_seconds"] < start_seconds + 0.5:
+            if time.monotonic() > deadline:
+                raise RuntimeError("El relay no llegó a llenar la ráfaga inicial")
+            time.sleep(0.1)
+        direct = [_read_until("127.0.0.1", origin_port, "/", needed) for _ in range(runs)]
+        relayed = [_read_until("127.0.0.1", relay_port, "/stream", needed) for _ in range(runs)]
+    finally:
+        server.shutdown()
+        origin.shutdown()
+        relay.stop()
+    print(f"{start_seconds:g} s de audio en el cliente ({runs} conexiones):")
+    print(f"  origen directo:  mediana {statistics.median(direct) * 1000:.0f} ms  (max {max(direct) * 1000:.0f} ms)")
+    print(f"  relay (ráfaga):  mediana {statistics.median(relayed) * 1000:.0f} ms  (max {max(relayed) * 1000:.0f} ms)")
+
+# ---------------- Transcodificación: escalera de bitrates ----------------
+# Para oyentes con poca red: el stream de origen se decodifica UNA vez (PCM
+# 16 bits pasa tal cual; el resto, con un único ffmpeg) y el PCM se reparte
+# a un ffmpeg codificador por escalón (MP3 a 32/64/128 kbps por defecto),
+# cada uno en su propio proceso de baja prioridad. Cada escalón tiene su
+# anillo (ráfaga inicial y política de oyentes lentos) y su URL /stream/<kbps>k.
+TRANSCODE_BITRATES = (32, 64, 128)
+TRANSCODE_RATE = 44100
+TRANSCODE_QUEUE = 64        # bloques de PCM pendientes por codificador
+TRANSCODE_RETRY = 10        # segundos mínimos entre rearranques de un ffmpeg caído
+
+def _ffmpeg():
+    import shutil
+    return config.get("ffmpeg_path") or shutil.which("ffmpeg")
+
+def _renice(proc, niceness):
+    """Baja la prioridad de un hijo ya lanzado; preexec_fn no es seguro con hilos."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, proc.pid, niceness)
+    except (AttributeError, OSError):
+        pass    # Windows, o el proceso ya terminó
+
+class Rendition:
+    def __init__(self, kbps, burst_seconds):
+        self.kbps = kbps
+        self.hub = StreamHub(burst_seconds)
+        self.dropped = 0
+        self._queue = None
+        self._proc = None
+
+    def start(self, ffmpeg, rate, channels):
+        import subprocess
+        self._kill()
+        self._queue = queue.Queue(TRANSCODE_QUEUE)
+        # por debajo de 48 kbps, mono a 22 kHz suena mejor que estéreo estrangulado
+        out = ["-ac", "1", "-ar", "22050"] if self.kbps <= 48 else ["-ac", "2", "-ar", str(TRANSCODE_RATE)]
+        self._proc = subprocess.Popen(
+            [ffmpeg, "-hide_banner", "-loglevel", "error", "-threads", "1",
+             "-f", "s16le", "-ar", str(rate), "-ac", str(channels), "-i", "pipe:0",
+             *out, "-c:a", "libmp3lame", "-b:a", f"{self.kbps}k", "-f", "mp3", "-flush_packets", "1", "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        _renice(self._proc, 5)
+        threading.Thread(target=self._write, args=(self._proc, self._queue), name=f"enc-{self.kbps}-in", daemon=True).start()
+        threading.Thread(target=self._read, args=(self._proc,), name=f"enc-{self.kbps}-out", daemon=True).start()
+
+    def feed(self, pcm):
+        # el mismo objeto bytes para todos los escalones: sin copias por codificador
+        try:
+            self._queue.put_nowait(pcm)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, proc, pending):
+        while True:
+            pcm = pending.get()
+            if pcm is None:
+                break
+            try:
+                proc.stdin.write(pcm)
+                proc.stdin.flush()
+            except (BrokenPipeError, ValueError, OSError):
+                break
+
+    def _read(self, proc):
+        # el codificador suelta trama a trama; se agrupan ~250 ms por chunk del anillo
+        block = self.kbps * 32
+        pending = bytearray()
+        while True:
+            data = proc.stdout.read1(UPSTREAM_CHUNK)
+            if not data:
+                break
+            pending += data
+            if len(pending) >= block:
+                self.hub.publish(bytes(pending), time.time())
+                pending.clear()
+        proc.wait()
+        _ladder_changed()   # codificador caído: deja de anunciarse
+
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def _kill(self):
+        if self._queue is not None:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass    # el proceso muere abajo y el hilo escritor sale con BrokenPipe
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+    def stop(self):
+        self._kill()
+        self.hub.close_all("transcodificación detenida")
+
+class Transcoder:
+    def __init__(self, bitrates, burst_seconds):
+        self.renditions = {kbps: Rendition(kbps, burst_seconds) for kbps in sorted(set(bitrates))}
+        self.decoder = None
+        self.decoders_started = 0
+        self.dropped = 0
+        self._queue = queue.Queue(TRANSCODE_QUEUE)
+        self._proc = None
+        self._spec = None
+        self._connection = None
+        self._retry_at = 0.0
+        self._stop = threading.Event()
+        threading.Thread(target=self._worker, name="transcode", daemon=True).start()
+
+    def on_chunk(self, data, now):
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self._stop.set()
+        self._queue.put(None)
+
+    def _start(self):
+        """Elige decodificador según el formato del origen y (re)arranca los
+        codificadores si el formato de PCM cambia o si alguno murió; los
+        anillos se conservan."""
+        import subprocess
+        self._connection = upstream.connections
+        self._retry_at = time.monotonic() + TRANSCODE_RETRY
+        ffmpeg = _ffmpeg()
+        if not ffmpeg:
+            app.logger.warning("Transcodificación: ffmpeg no instalado.")
+            return "ninguno"
+        fmt = _wav_format(upstream.header) if upstream.header else None
+        if fmt and fmt[2] == 16:
+            spec = ("pcm", fmt[1], fmt[0])
+        else:
+            spec = ("ffmpeg", TRANSCODE_RATE, 2)
+        # mismo formato: un ffmpeg decodificador vivo acepta streams encadenados
+        changed = spec != self._spec
+        decoder, rate, channels = self._spec = spec
+        if self._proc is not None and (changed or decoder != "ffmpeg" or self._proc.poll() is not None):
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+        if decoder == "ffmpeg" and self._proc is None:
+            self._proc = subprocess.Popen(
+                [ffmpeg, "-hide_banner", "-loglevel", "error", "-threads", "1", "-i", "pipe:0",
+                 "-ac", str(channels), "-ar", str(rate), "-f", "s16le", "pipe:1"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            _renice(self._proc, 5)
+            self.decoders_started += 1
+            threading.Thread(target=self._read_pcm, args=(self._proc.stdout,), daemon=True).start()
+            try:
+                # WAV que no es de 16 bits: ffmpeg necesita la cabecera que el tap quitó
+                self._proc.stdin.write(upstream.header)
+            except (BrokenPipeError, ValueError):
+                pass    # el worker lo ve al escribir y reintenta pasado TRANSCODE_RETRY
+        self.decoder = decoder  # antes de avisar: la vista pública lo consulta
+        restarted = [r for r in self.renditions.values() if changed or not r.alive()]
+        for rendition in restarted:
+            rendition.start(ffmpeg, rate, channels)
+        if restarted:
+            _ladder_changed()
+        return decoder
+
+    def _healthy(self):
+        if self.decoder == "ninguno":
+            return True     # sin ffmpeg no hay nada que rearrancar
+        if self.decoder == "ffmpeg" and (self._proc is None or self._proc.poll() is not None):
+            return False
+        return self.decoder != "error" and all(r.alive() for r in self.renditions.values())
+
+    def _distribute(self, pcm):
+        for rendition in self.renditions.values():
+            rendition.feed(pcm)
+
+    def _worker(self):
+        while not self._stop.is_set():
+            data = self._queue.get()
+            if data is None:
+                break
+            if (self.decoder is None or upstream.connections != self._connection
+                    or (time.monotonic() >= self._retry_at and not self._healthy())):
+                self.decoder = self._start()
+            if self.decoder == "pcm":
+                self._distribute(data)
+            elif self.decoder == "ffmpeg":
+                try:
+                    self._proc.stdin.write(data)
+                    self._proc.stdin.flush()
+                except (BrokenPipeError, ValueError, OSError):
+                    app.logger.warning("Transcodificación: el decodificador terminó.")
+                    self.decoder = "error"
+                    _ladder_changed()
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+        for rendition in self.renditions.values():
+            rendition.stop()
+
+    def _read_pcm(self, stream):
+        while not self._stop.is_set():
+            pcm = stream.read1(UPSTREAM_CHUNK)
+            if not pcm:
+                break
+            self._distribute(pcm)
+
+    def status(self):
+        return {
+            "decoder": self.decoder,
+            "decoders_started": self.decoders_started,
+            "dropped_chunks": self.dropped,
+            "renditions": {f"{kbps}k": {"encoder": r.alive(), "dropped_pcm": r.dropped, **r.hub.stats(top=5)}
+                           for kbps, r in self.renditions.items()},
+        }
+
+transcoder = None
+
+def rendition_urls(cfg):
+    """Escalera pública [{"kbps", "url"}] de menor a mayor con los escalones
+    cuyo codificador está vivo; [] si está desactivada o sin ffmpeg."""
+    if not cfg.get("transcode_enabled") or transcoder is None or transcoder.decoder not in ("pcm", "ffmpeg"):
+        return []
+    return [{"kbps": kbps, "url": url_for("rendition_stream", kbps=kbps, _external=True)}
+            for kbps, rendition in transcoder.renditions.items() if rendition.alive()]
+
+def _ladder_changed():
+    # los escalones vivos forman parte de las páginas públicas
+    invalidate_views({"transcode"})
+    schedule_static_export()
+
+def apply_transcode_config():
+    global transcoder
+    if transcoder is not None:
+        upstream.unsubscribe(transcoder.on_chunk)
+        transcoder.close()
+        transcoder = None
+    if config.get("transcode_enabled"):
+        transcoder = Transcoder(config.get("transcode_bitrates", TRANSCODE_BITRATES),
+                                config.get("relay_burst_seconds", RELAY_BURST_SECONDS))
+        upstream.subscribe(transcoder.on_chunk)
+
+@on_config_change
+def _transcode_on_change(keys):
+    if keys & {"transcode_enabled", "transcode_bitrates", "relay_burst_seconds", "ffmpeg_path"}:
+        apply_transcode_config()
+
+@app.route("/stream/<int:kbps>k")
+def rendition_stream(kbps):
+    rendition = transcoder.renditions.get(kbps) if transcoder else None
+    if rendition is None:
+        return "Escalón no disponible", 404
+    if not rendition.alive():
+        return _unavailable("Preparando el escalón")
+    return stream_response(listen_hub(rendition.hub, addr=request.remote_addr), "audio/mpeg")
+
+@app.route("/admin/api/transcode")
+@login_required
+def admin_transcode():
+    return jsonify(transcoder.status() if transcoder else {"decoder": None, "renditions": {}})
+
+# ---------------- Grabación de la emisión ----------------
+# Copia el stream tal cual (sin decodificar) en segmentos por tiempo dentro de
+# recorder_dir, con escritura en bloques grandes. index.jsonl guarda el inicio
+# de cada segmento y un punto (instante -> offset) cada RECORDER_CHECKPOINT
+# segundos, de modo que un rango horario se traduce en ficheros y offsets con
+# una búsqueda binaria, sin leer los ficheros.
+RECORDER_DIR = "recordings"
+RECORDER_SEGMENT_SECONDS = 3600
+RECORDER_MAX_BYTES = 2 * 1024 ** 3
+RECORDER_MAX_AGE_DAYS = 7
+RECORDER_CHECKPOINT = 10
+RECORDER_BUFFER = 1 << 20
+
+class Recorder:
+    def __init__(self, directory, segment_seconds, max_bytes, max_age_days):
+        self.dir = Path(directory)
+        if not self.dir.is_absolute():
+            self.dir = BASE_DIR / self.dir
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.index_path = self.dir / "index.jsonl"
+        self.segments = []       # [{"file", "start", "end", "size", "header", "points": [(t, offset)]}]
+        self._lock = threading.Lock()
+        self._file = None
+        self._index = None
+        self._current = None
+        self._load_index()
+
+    def _load_index(self):
+        by_file = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        break
+                    seg = by_file.get(e["f"])
+                    if seg is None:
+                        seg = by_file[e["f"]] = {"file": e["f"], "start": e["t"], "end": e["t"],
+                                                 "size": 0, "header": e.get("h", 0), "points": []}
+                        self.segments.append(seg)
+                    seg["points"].append((e["t"], e["o"]))
+                    seg["end"], seg["size"] = e["t"], e["o"]
+        except FileNotFoundError:
+            pass
+        # el tamaño real puede ir por delante del último punto
+        self.segments = [s for s in self.segments if (self.dir / s["file"]).exists()]
+        for seg in self.segments:
+            seg["size"] = (self.dir / seg["file"]).stat().st_size
+
+    def _log_point(self, seg, t, offset, header=None):
+        entry = {"f": seg["file"], "t": round(t, 3), "o": offset}
+        if header is not None:
+            entry["h"] = header
+        # una línea cada RECORDER_CHECKPOINT s: se escribe al momento (buffering=1)
+        # para que un proceso matado no deje segmentos fuera del índice
+        self._index.write(json.dumps(entry) + "\n")
+        seg["points"].append((entry["t"], offset))
+        seg["end"], seg["size"] = entry["t"], offset
+
+    def _rotate(self, now):
+        self._close_segment(now)
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + self._extension()
+        self._file = open(self.dir / name, "wb", buffering=RECORDER_BUFFER)
+        if self._index is None:
+            self._index = open(self.index_path, "a", encoding="utf-8", buffering=1)
+        header = upstream.header
+        if header:
+            self._file.write(header)
+        self._current = {"file": name, "start": now, "end": now, "size": 0,
+                         "header": len(header), "points": []}
+        self.segments.append(self._current)
+        self._log_point(self._current, now, len(header), header=len(header))
+        self._enforce_retention(now)
+
+    def _extension(self):
+        ctype = upstream.content_type
+        for key, ext in (("mpeg", ".mp3"), ("aac", ".aac"), ("ogg", ".ogg"), ("wav", ".wav"), ("opus", ".opus")):
+            if key in ctype:
+                return ext
+        return ".bin"
+
+    def _close_segment(self, now):
+        if self._file is not None:
+            self._log_point(self._current, now, self._file.tell())
+            self._file.close()
+            self._index.flush()
+            self._file = None
+            self._current = None
+
+    def on_chunk(self, data, now):
+        with self._lock:
+            if self._current is None or now - self._current["start"] >= self.segment_seconds:
+                self._rotate(now)
+            self._file.write(data)
+            if now - self._current["points"][-1][0] >= RECORDER_CHECKPOINT:
+                self._log_point(self._current, now, self._file.tell())
+
+    def _enforce_retention(self, now):
+        total = sum(s["size"] for s in self.segments)
+        removed = False
+        while len(self.segments) > 1 and (
+                total > self.max_bytes or now - self.segments[0]["end"] > self.max_age):
+            seg = self.segments.pop(0)
+            total -= seg["size"]
+            (self.dir / seg["file"]).unlink(missing_ok=True)
+            removed = True
+        if removed:
+            self._compact_index()
+
+    def _compact_index(self):
+        lines = []
+        for seg in self.segments:
+            for i, (t, o) in enumerate(seg["points"]):
+                e = {"f": seg["file"], "t": t, "o": o}
+                if i == 0:
+                    e["h"] = seg["header"]
+                lines.append(json.dumps(e))
+        self._index.close()
+        _atomic_write(self.index_path, "".join(line + "\n" for line in lines))
+        self._index = open(self.index_path, "a", encoding="utf-8", buffering=1)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._index.flush()
+                self._current["size"] = self._file.tell()
+
+    def close(self):
+        with self._lock:
+            self._close_segment(time.time())
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+    def locate(self, t):
+        """(segmento, offset) más cercano por debajo del instante t."""
+        from bisect import bisect_right
+        i = bisect_right([s["start"] for s in self.segments], t) - 1
+        if i < 0:
+            return (self.segments[0], self.segments[0]["header"]) if self.segments else (None, 0)
+        seg = self.segments[i]
+        j = bisect_right([p[0] for p in seg["points"]], t) - 1
+        return seg, seg["points"][max(j, 0)][1]
+
+    def range_parts(self, t_from, t_to):
+        """Lista de (fichero, desde, hasta) que cubre [t_from, t_to]."""
+        from bisect import bisect_right
+        self.flush()
+        with self._lock:
+            first, start = self.locate(t_from)
+            if first is None:
+                return [], 0
+            last, _ = self.locate(t_to)
+            i, k = self.segments.index(first), self.segments.index(last)
+            parts = []
+            for seg in self.segments[i:k + 1]:
+                begin = start if seg is first else seg["header"]
+                if seg is last:
+                    times = [p[0] for p in seg["points"]]
+                    j = bisect_right(times, t_to)
+                    end = seg["points"][j][1] if j < len(times) else seg["size"]
+                else:
+                    end = seg["size"]
+                if end > begin:
+                    parts.append((self.dir / seg["file"], begin, end))
+            return parts, first["header"]
+
+recorder = None
+
+def apply_recorder_config():
+    global recorder
+    wanted = bool(config.get("recorder_enabled"))
+    if recorder is not None and not wanted:
+        upstream.unsubscribe(recorder.on_chunk)
+        recorder.close()
+        recorder = None
+    elif wanted and recorder is None:
+        recorder = Recorder(config.get("recorder_dir", RECORDER_DIR),
+                            config.get("recorder_segment_seconds", RECORDER_SEGMENT_SECONDS),
+                            config.get("recorder_max_bytes", RECORDER_MAX_BYTES),
+                            config.get("recorder_max_age_days", RECORDER_MAX_AGE_DAYS))
+        upstream.subscribe(recorder.on_chunk)
+
+@atexit.register
+def _close_recorder():
+    if recorder is not None:
+        recorder.close()
+
+@on_config_change
+def _recorder_on_change(keys):
+    if any(k.startswith("recorder_") for k in keys):
+        apply_recorder_config()
+
+def _parse_when(value):
+    from datetime import datetime
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route("/admin/recordings")
+@login_required
+def admin_recordings():
+    if recorder is None:
+        return jsonify([])
+    recorder.flush()
+    return jsonify([{"file": s["file"], "start": s["start"], "end": s["end"], "size": s["size"],
+                     "url": url_for("admin_recording_file", name=s["file"])}
+                    for s in reversed(recorder.segments)])
+
+@app.route("/admin/recordings/file/<name>")
+@login_required
+def admin_recording_file(name):
+    from flask import send_from_directory
+    if recorder is None:
+        return ("Grabación desactivada", 404)
+    recorder.flush()
+    return send_from_directory(recorder.dir, name, conditional=True)
+
+@app.route("/admin/recordings/range")
+@login_required
+def admin_recording_range():
+    """Sirve el audio entre ?from= y ?to= (epoch o ISO 8601) usando el índice."""
+    if recorder is None:
+        return ("Grabación desactivada", 404)
+    try:
+        t_from, t_to = _parse_when(request.args.get("from")), _parse_when(request.args.get("to"))
+    except (TypeError, ValueError):
+        return ("Parámetros from/to inválidos", 400)
+    parts, header_len = recorder.range_parts(t_from, t_to) if t_to > t_from else ([], 0)
+    if not parts:
+        return ("No hay grabación en ese rango", 404)
+    # el primer punto de un segmento es justo el fin de la cabecera: también la lleva
+    with_header = header_len and parts[0][1] >= header_len
+
+    def generate():
+        if with_header:
+            with open(parts[0][0], "rb") as f:
+                yield f.read(header_len)
+        for path, begin, end in parts:
+            with open(path, "rb") as f:
+                f.seek(begin)
+                remaining = end - begin
+                while remaining > 0:
+                    chunk = f.read(min(RECORDER_BUFFER, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+    length = sum(end - begin for _, begin, end in parts)
+    if with_header:
+        length += header_len
+    resp = app.response_class(generate(), mimetype=upstream.content_type or "application/octet-stream")
+    resp.headers["Content-Length"] = str(length)
+    resp.headers["Content-Disposition"] = f'attachment; filename="radiostream-{int(t_from)}{parts[0][0].suffix}"'
+    return resp
+
+# ---------------- Análisis de audio: volumen y silencio ----------------
+# Escucha el stream compartido y calcula el nivel RMS en ventanas de 100 ms a
+# baja resolución (~8 kHz, un canal). PCM/WAV se analiza directamente; el resto
+# de formatos se decodifica con un ffmpeg de baja prioridad si está instalado.
+# Con numpy disponible el cálculo es vectorizado. Si el nivel se queda por
+# debajo de silence_threshold_db durante silence_seconds se lanza una alerta
+# que se ve en /admin y se envía a los canales registrados (alert_webhook).
+ANALYSIS_RATE = 8000
+ANALYSIS_WINDOW = 0.1
+ANALYSIS_SHORT_TERM = 3.0
+SILENCE_THRESHOLD_DB = -50.0
+SILENCE_SECONDS = 15
+SILENCE_HYSTERESIS_DB = 3.0
+ANALYSIS_RETRY = 10         # segundos de espera antes de relanzar un ffmpeg que falló
+
+def _wav_format(header):
+    """(canales, frecuencia, bits) del chunk fmt de una cabecera WAV."""
+    pos = 12
+    while pos + 8 <= len(header):
+        cid, size = header[pos:pos + 4], int.from_bytes(header[pos + 4:pos + 8], "little")
+        if cid == b"fmt ":
+            fmt = header[pos + 8:pos + 8 + 16]
+            return (int.from_bytes(fmt[2:4], "little"), int.from_bytes(fmt[4:8], "little"),
+                    int.from_bytes(fmt[14:16], "little"))
+        pos += 8 + size + (size & 1)
+    return None
+
+# numpy tarda en importarse, así que sólo se carga con la primera ventana analizada.
+_np = None
+
+def _numpy():
+    global _np
+    if _np is None:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = False
+    return _np or None
+
+def mean_square(block, step=1):
+    """Energía media de muestras s16le, tomando una de cada `step`."""
+    np = _numpy()
+    if np is not None:
+        x = np.frombuffer(block, dtype="<i2")[::step].astype(np.float32)
+        return float(np.dot(x, x)) / len(x) if len(x) else 0.0
+    from array import array
+    samples = array("h")
+    samples.frombytes(bytes(block))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    samples = samples[::step]
+    return sum(v * v for v in samples) / len(samples) if samples else 0.0
+
+def to_dbfs(ms):
+    import math
+    return 10 * math.log10(ms / 32768.0 ** 2) if ms > 0 else -120.0
+
+alerts = deque(maxlen=50)
+_alert_listeners = []
+
+def on_alert(fn):
+    _alert_listeners.append(fn)
+    return fn
+
+def raise_alert(kind, message, active=True):
+    alert = {"ts": time.time(), "kind": kind, "message": message, "active": active}
+    alerts.append(alert)
+    app.logger.warning("Alerta %s: %s", kind, message)
+    for fn in list(_alert_listeners):
+        try:
+            fn(alert)
+        except Exception:
+            app.logger.exception("Error enviando alerta")
+
+@on_alert
+def _alert_webhook(alert):
+    url = config.get("alert_webhook")
+    if not url:
+        return
+
+    def send():
+        from urllib.request import Request, urlopen
+        body = json.dumps({"station": config.get("station_label", ""), **alert}).encode()
+        try:
+            urlopen(Request(url, data=body, headers={"Content-Type": "application/json"}), timeout=10).close()
+        except OSError as e:
+            app.logger.warning("No se pudo enviar la alerta a %s: %s", url, e)
+    threading.Thread(target=send, daemon=True).start()
+
+class AudioAnalyzer:
+    def __init__(self, threshold_db, silence_seconds):
+        self.threshold_db = threshold_db
+        self.silence_seconds = silence_seconds
+        self.level_db = None            # última ventana
+        self.loudness_db = None         # media de los últimos ANALYSIS_SHORT_TERM s
+        self.silent_since = None
+        self.alert_active = False
+        self.dropped = 0
+        self.decoder = None
+        self.history = deque(maxlen=300)   # (t, dB) por segundo
+        self._energies = deque(maxlen=int(ANALYSIS_SHORT_TERM / ANALYSIS_WINDOW))
+        self._queue = queue.Queue(maxsize=64)
+        self._proc = None
+        self._retry_at = 0.0
+        self._stop = threading.Event()
+        threading.Thread(target=self._worker, name="analysis", daemon=True).start()
+
+    def on_chunk(self, data, now):
+        # se llama desde el hilo del stream: nunca bloquear; si vamos tarde, se muestrea
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self._stop.set()
+        self._queue.put(None)
+
+    def _start_ffmpeg(self):
+        import subprocess
+        ffmpeg = _ffmpeg()
+        if not ffmpeg:
+            return None
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = subprocess.Popen(
+            [ffmpeg, "-hide_banner", "-loglevel", "error", "-threads", "1", "-i", "pipe:0",
+             "-ac", "1", "-ar", str(ANALYSIS_RATE), "-f", "s16le", "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        _renice(self._proc, 10)
+        threading.Thread(target=self._read_pcm, args=(self._proc.stdout, ANALYSIS_RATE, 1, 1),
+                         daemon=True).start()
+        try:
+            # el tap quita la cabecera WAV del stream; sin ella ffmpeg no reconoce el PCM
+            self._proc.stdin.write(upstream.header)
+        except (BrokenPipeError, ValueError):
+            return "error"
+        return "ffmpeg"
+
+    def _worker(self):
+        pending = bytearray()
+        fmt = None
+        while not self._stop.is_set():
+            data = self._queue.get()
+            if data is None:
+                break
+            if self.decoder is None or (self.decoder == "error" and time.monotonic() >= self._retry_at):
+                self._retry_at = time.monotonic() + ANALYSIS_RETRY
+                fmt = _wav_format(upstream.header) if upstream.header else None
+                if fmt and fmt[2] == 16:
+                    self.decoder = "pcm"
+                else:
+                    self.decoder = self._start_ffmpeg() or "ninguno"
+                    if self.decoder == "ninguno":
+                        app.logger.warning("Análisis de audio: formato no PCM y ffmpeg no instalado.")
+            if self.decoder == "pcm":
+                channels, rate, _ = fmt
+                decim = max(1, rate // ANALYSIS_RATE)
+                pending += data
+                self._consume(pending, rate, channels, decim)
+            elif self.decoder == "ffmpeg":
+                try:
+                    self._proc.stdin.write(data)
+                except (BrokenPipeError, ValueError):
+                    # se reintenta pasado ANALYSIS_RETRY, no con cada chunk
+                    app.logger.warning("Análisis de audio: ffmpeg terminó; se reintentará.")
+                    self.decoder = "error"
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+
+    def _read_pcm(self, stream, rate, channels, decim):
+        pending = bytearray()
+        while not self._stop.is_set():
+            data = stream.read1(1 << 14) if hasattr(stream, "read1") else stream.read(1 << 14)
+            if not data:
+                break
+            pending += data
+            self._consume(pending, rate, channels, decim)
+
+    def _consume(self, pending, rate, channels, decim):
+        window = int(rate * ANALYSIS_WINDOW) * 2 * channels
+        while len(pending) >= window:
+            ms = mean_square(memoryview(pending)[:window], channels * decim)
+            del pending[:window]
+            self._update(ms, time.time())
+
+    def _update(self, ms, now):
+        self.level_db = to_dbfs(ms)
+        self._energies.append(ms)
+        self.loudness_db = to_dbfs(sum(self._energies) / len(self._energies))
+        if not self.history or now - self.history[-1][0] >= 1:
+            self.history.append((round(now, 1), round(self.loudness_db, 1)))
+        if self.level_db < self.threshold_db:
+            if self.silent_since is None:
+                self.silent_since = now
+            elif not self.alert_active and now - self.silent_since >= self.silence_seconds:
+                self.alert_active = True
+                raise_alert("silence", f"Silencio en antena desde las "
+                            f"{time.strftime('%H:%M:%S', time.localtime(self.silent_since))}")
+        elif self.level_db > self.threshold_db + SILENCE_HYSTERESIS_DB:
+            self.silent_since = None
+            if self.alert_active:
+                self.alert_active = False
+                raise_alert("silence", "Vuelve a haber audio en antena", active=False)
+
+    def status(self):
+        return {
+            "decoder": self.decoder,
+            "level_db": self.level_db,
+            "loudness_db": self.loudness_db,
+            "silent_since": self.silent_since,
+            "silence": self.alert_active,
+            "dropped_chunks": self.dropped,
+            "history": list(self.history),
+        }
+
+analyzer = None
+
+def apply_analysis_config():
+    global analyzer
+    wanted = bool(config.get("analysis_enabled"))
+    if analyzer is not None:
+        upstream.unsubscribe(analyzer.on_chunk)
+        analyzer.close()
+        analyzer = None
+    if wanted:
+        analyzer = AudioAnalyzer(config.get("silence_threshold_db", SILENCE_THRESHOLD_DB),
+                                 config.get("silence_seconds", SILENCE_SECONDS))
+        upstream.subscribe(analyzer.on_chunk)
+
+@on_config_change
+def _analysis_on_change(keys):
+    if keys & {"analysis_enabled", "silence_threshold_db", "silence_seconds", "audio_url", "ffmpeg_path"}:
+        apply_analysis_config()
+
+@app.route("/admin/api/analysis")
+@login_required
+def admin_analysis():
+    return jsonify({
+        "enabled": analyzer is not None,
+        **(analyzer.status() if analyzer else {}),
+        "alerts": list(alerts)[-10:],
+    })
+
+def serve_tone(port, tone_seconds=30.0, silence_seconds=0.0, rate=ANALYSIS_RATE):
+    """Origen de pruebas local: WAV PCM sin fin con un tono de 440 Hz y, si se
+    pide, silencios periódicos (tone_seconds de tono, silence_seconds de silencio)."""
+    import math
+    import struct
+    from array import array
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    block = int(rate * ANALYSIS_WINDOW)
+    tone = array("h", (int(8000 * math.sin(2 * math.pi * 440 * i / rate)) for i in range(rate)))
+    if sys.byteorder == "big":
+        tone.byteswap()
+    tone = tone.tobytes()
+    silence = bytes(block * 2)
+    header = (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt "
+              + struct.pack("<IHHIIHH", 16, 1, 1, rate, rate * 2, 2, 16)
+              + b"data" + struct.pack("<I", 0xFFFFFFFF))
+    period = tone_seconds + silence_seconds
+
+    class ToneHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/wav")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            start = time.monotonic()
+            sent = 0
+            try:
+                self.wfile.write(header)
+                while True:
+                    t = sent / rate
+                    if silence_seconds and (t % period) >= tone_seconds:
+                        chunk = silence
+                    else:
+                        offset = (sent % rate) * 2
+                        chunk = (tone[offset:] + tone)[:block * 2]
+                    self.wfile.write(chunk)
+                    sent += block
+                    # ritmo de tiempo real
+                    delay = start + sent / rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+            except OSError:
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), ToneHandler)
+    server.daemon_threads = True
+    return server
+
+# ---------------- Telemetría de oyentes (QoE) ----------------
+# Los lotes de los reproductores se agregan en histogramas de tamaño fijo
+# (cubos logarítmicos en ms) por host que embebe y por espejo (host del
+# stream). Todo en memoria y con número de claves acotado: cada beacon cuesta
+# unas pocas búsquedas binarias.
+QOE_BUCKETS_MS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000,
+                  7500, 10000, 15000, 30000, 60000)
+QOE_MAX_KEYS = 100
+QOE_MAX_BODY = 4096
+QOE_MAX_VALUES = 50
+QOE_ERROR_NAMES = {1: "abortado", 2: "red", 3: "decodificación", 4: "formato no soportado"}
+
+class Histogram:
+    __slots__ = ("counts", "total", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(QOE_BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum = 0
+
+    def add(self, value):
+        from bisect import bisect_left
+        self.counts[bisect_left(QOE_BUCKETS_MS, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """Límite superior (ms) del cubo que contiene el percentil p; None si
+        está vacío y ">60000" si cae en el último cubo abierto."""
+        if not self.total:
+            return None
+        target = p / 100 * self.total
+        seen = 0
+        for i, n in enumerate(self.counts[:-1]):
+            seen += n
+            if seen >= target:
+                return QOE_BUCKETS_MS[i]
+        return f">{QOE_BUCKETS_MS[-1]}"
+
+class QoEStats:
+    __slots__ = ("beacons", "ttfa", "stalls", "errors")
+
+    def __init__(self):
+        self.beacons = 0
+        self.ttfa = Histogram()
+        self.stalls = Histogram()
+        self.errors = {}
+
+    def summary(self):
+        return {
+            "beacons": self.beacons,
+            "ttfa_n": self.ttfa.total,
+            "ttfa_p50": self.ttfa.percentile(50),
+            "ttfa_p90": self.ttfa.percentile(90),
+            "ttfa_p99": self.ttfa.percentile(99),
+            "stalls": self.stalls.total,
+            "stall_ms_total": self.stalls.sum,
+            "stall_p90": self.stalls.percentile(90),
+            "errors": {QOE_ERROR_NAMES.get(k, str(k)): v for k, v in self.errors.items()},
+        }
+
+qoe = {"host": {}, "mirror": {}}
+_qoe_lock = threading.Lock()
+
+def _qoe_bucket(dimension, key):
+    table = qoe[dimension]
+    key = (str(key) or "desconocido")[:100]
+    stats = table.get(key)
+    if stats is None:
+        if len(table) >= QOE_MAX_KEYS:
+            key = "otros"
+            stats = table.get(key)
+        if stats is None:
+            stats = table[key] = QoEStats()
+    return stats
+
+def _qoe_values(payload, name, low, high):
+    values = payload.get(name) or []
+    if not isinstance(values, list):
+        return []
+    return [v for v in values[:QOE_MAX_VALUES] if isinstance(v, (int, float)) and low <= v <= high]
+
+@app.route("/api/qoe", methods=["POST"])
+def qoe_ingest():
+    # nunca se lee más de QOE_MAX_BODY + 1 bytes, ni siquiera sin Content-Length
+    if (request.content_length or 0) > QOE_MAX_BODY:
+        return ("", 413)
+    data = request.stream.read(QOE_MAX_BODY + 1)
+    if len(data) > QOE_MAX_BODY:
+        return ("", 413)
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return ("", 400)
+    if not isinstance(payload, dict):
+        return ("", 400)
+    ttfa = _qoe_values(payload, "ttfa", 0, 600000)
+    stalls = _qoe_values(payload, "stalls", 0, 3600000)
+    errors = [int(v) for v in _qoe_values(payload, "errors", 1, 4)]
+    with _qoe_lock:
+        for stats in (_qoe_bucket("host", payload.get("host", "")),
+                      _qoe_bucket("mirror", payload.get("mirror", ""))):
+            stats.beacons += 1
+            for v in ttfa:
+                stats.ttfa.add(v)
+            for v in stalls:
+                stats.stalls.add(v)
+            for code in errors:
+                stats.errors[code] = stats.errors.get(code, 0) + 1
+    resp = app.response_class(status=204)
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+def qoe_summary():
+    with _qoe_lock:
+        return {dim: sorted(((k, s.summary()) for k, s in table.items()),
+                            key=lambda item: -item[1]["beacons"])
+                for dim, table in qoe.items()}
+
+@app.route("/admin/api/qoe")
+@login_required
+def admin_qoe():
+    return jsonify({dim: dict(rows) for dim, rows in qoe_summary().items()})
+
+# ---------------- Arranque rápido ----------------
+# Las plantillas se compilan una sola vez (render_template_string recompila en
+# cada petición) y las páginas públicas se calientan antes de abrir el socket.
+TEMPLATES = {}
+
+def compile_templates():
+    app.jinja_env.globals["qoe_script"] = QOE_JS
+    app.jinja_env.globals["buffer_script"] = BUFFER_JS
+    app.jinja_env.globals["abr_script"] = ABR_JS
+    sources = {
+        "index": INDEX_HTML,
+        "embed": EMBED_HTML,
+        "login": LOGIN_HTML,
+        "admin": ADMIN_HTML,
+    }
+    for name, source in sources.items():
+        TEMPLATES[name] = app.jinja_env.from_string(source)
+
+def warm_up():
+    """Compila las plantillas y, si hay public_url, deja en la caché de vistas
+    las páginas de ese host; sin public_url la primera visita de cada host
+    todavía construye su vista."""
+    bases = ["http://localhost/"]
+    if config.get("public_url"):
+        bases.append(config["public_url"].rstrip("/") + "/")
+    with app.test_client() as client:
+        for base in bases:
+            for path in ("/", "/embed", "/login"):
+                client.get(path, base_url=base).close()
+
+compile_templates()
+
+def _free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def bench_startup(runs=5):
+    """Mide el tiempo de import y el tiempo hasta el primer byte tras arrancar."""
+    import socket
+    import statistics
+    import subprocess
+
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); "
+            "import %s; print(time.perf_counter() - t)") % (str(BASE_DIR), Path(__file__).stem)
+    imports, ttfbs = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR,
+                             capture_output=True, text=True, check=True)
+        imports.append(float(out.stdout.strip().splitlines()[-1]))
+
+        port = _free_port()
+        t0 = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--port", str(port)],
+                                cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                if proc.poll() is not None:
+                    raise RuntimeError("El servidor terminó antes de responder")
+                if time.perf_counter() - t0 > 30:
+                    raise RuntimeError("Timeout esperando el primer byte")
+                try:
+                    with socket.create_connection(("127.0.0.1", port), timeout=5) as conn:
+                        conn.sendall(b"GET / HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n")
+                        if conn.recv(1):
+                            ttfbs.append(time.perf_counter() - t0)
+                            break
+                except OSError:
+                    time.sleep(0.005)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print(f"import:            mediana {statistics.median(imports) * 1000:.1f} ms  (min {min(imports) * 1000:.1f} ms)")
+    print(f"primer byte de /:  mediana {statistics.median(ttfbs) * 1000:.1f} ms  (min {min(ttfbs) * 1000:.1f} ms)")
+
+# ---------------- Exportación estática ----------------
+# Genera index.html, embed.html, embed-autoplay.html, api/station.json y los
+# assets con hash (más variantes .gz/.br) para que nginx o una CDN sirvan todo
+# el tráfico de oyentes; Flask sólo atiende /admin y /login. Cada exportación
+# se construye en un directorio nuevo y se publica cambiando un enlace
+# simbólico de forma atómica. Se relanza sola tras cada guardado si
+# config["static_export_dir"] está definido.
+EXPORT_DELAY = 1.0
+_COMPRESSIBLE = (".html", ".js", ".json", ".css")
+
+_export_lock = threading.Lock()
+_export_timer = None
+
+def _write_compressed(path, data):
+    import gzip
+    path.write_bytes(data)
+    if path.suffix in _COMPRESSIBLE:
+        path.with_name(path.name + ".gz").write_bytes(gzip.compress(data, 9, mtime=0))
+        try:
+            import brotli
+        except ImportError:
+            return
+        path.with_name(path.name + ".br").write_bytes(brotli.compress(data))
+
+def _publish_dir(link, build):
+    """Apunta `link` a `build` con un rename atómico del enlace simbólico."""
+    if link.exists() and not link.is_symlink():
+        # primera exportación sobre un directorio normal: se aparta una vez
+        link.rename(link.with_name(f".{link.name}.old-{int(time.time())}"))
+    tmp = link.with_name(f".{link.name}.link")
+    if tmp.is_symlink() or tmp.exists():
+        tmp.unlink()
+    tmp.symlink_to(build.name)
+    os.replace(tmp, link)
+    _fsync_dir(link.parent)
+
+def _prune_builds(link, keep=2):
+    import shutil
+    current = os.readlink(link) if link.is_symlink() else None
+    builds = sorted(link.parent.glob(f".{link.name}.build-*"))
+    for old in builds[:-keep]:
+        if old.name != current:
+            shutil.rmtree(old, ignore_errors=True)
+
+def export_static(out_dir=None):
+    """Exporta las páginas públicas ya renderizadas a `out_dir` (enlace simbólico)."""
+    out_dir = out_dir or config.get("static_export_dir")
+    if not out_dir:
+        raise ValueError("No hay directorio de exportación (static_export_dir).")
+    link = Path(out_dir).absolute()
+    link.parent.mkdir(parents=True, exist_ok=True)
+    base_url = (config.get("public_url") or f"http://localhost:{config.get('port', DEFAULT_PORT)}").rstrip("/")
+
+    with _export_lock:
+        build = link.with_name(f".{link.name}.build-{time.time_ns()}")
+        assets = build / "assets"
+        assets.mkdir(parents=True)
+        hashed = {}
+
+        def asset_url(name):
+            if name not in hashed:
+                data = (STATIC_DIR / name).read_bytes()
+                stem, _, ext = name.rpartition(".")
+                # theme-<hash>.css ya lleva el hash en el nombre
+                hashed_name = name if name.startswith("theme-") else f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{ext}"
+                _write_compressed(assets / hashed_name, data)
+                hashed[name] = f"/assets/{hashed_name}"
+            return hashed[name]
+
+        widget_name = f"embed.{EMBED_JS_VERSION}.js"
+        _write_compressed(assets / widget_name, EMBED_JS.encode())
+
+        cfg = active["config"]
+        with app.test_request_context("/", base_url=base_url):
+            ctx = public_context(cfg, asset_url)
+            pages = {
+                "index.html": render_template(TEMPLATES["index"], embed_url=f"{base_url}/embed",
+                                              widget_url=f"{base_url}/assets/{widget_name}", **ctx),
+                "embed.html": render_template(TEMPLATES["embed"], force_autoplay=False, **ctx),
+                "embed-autoplay.html": render_template(TEMPLATES["embed"], force_autoplay=True, **ctx),
+                "api/station.json": json.dumps(station_data(cfg, lambda name: base_url + asset_url(name)),
+                                               ensure_ascii=False),
+            }
+        for rel, text in pages.items():
+            path = build / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _write_compressed(path, text.encode("utf-8"))
+
+        _publish_dir(link, build)
+        _prune_builds(link)
+    return link
+
+def _export_in_background():
+    global _export_timer
+    _export_timer = None
+    try:
+        export_static()
+    except Exception:
+        app.logger.exception("Falló la exportación estática")
+
+def schedule_static_export(delay=EXPORT_DELAY):
+    """Agrupa cambios seguidos en una sola exportación (si está configurada)."""
+    global _export_timer
+    if not config.get("static_export_dir"):
+        return
+    if _export_timer is not None:
+        _export_timer.cancel()
+    _export_timer = threading.Timer(delay, _export_in_background)
+    _export_timer.daemon = True
+    _export_timer.start()
+
+@on_config_change
+def _export_on_change(keys):
+    if keys & PUBLIC_KEYS:
+        schedule_static_export()
+
+# ---------------- Servidor: socket heredado y relevo sin cortes ----------------
+# El socket de escucha puede venir de systemd (activación por socket, fd 3) o de
+# un proceso anterior (RADIOSTREAM_FD). Con SIGHUP el proceso arranca un sucesor
+# que hereda el socket y, cuando éste está listo, deja de aceptar conexiones y
+# espera a que terminen las peticiones en curso antes de salir.
+SD_LISTEN_FDS_START = 3
+DEFAULT_DRAIN_TIMEOUT = 30
+
+_active_lock = threading.Lock()
+_active_requests = 0
+_handover_lock = threading.Lock()
+shutting_down = threading.Event()
+
+def _request_done():
+    global _active_requests
+    with _active_lock:
+        _active_requests -= 1
+
+def _track_active(wsgi_app):
+    from werkzeug.wsgi import ClosingIterator
+
+    def wrapped(environ, start_response):
+        global _active_requests
+        with _active_lock:
+            _active_requests += 1
+        try:
+            app_iter = wsgi_app(environ, start_response)
+        except BaseException:
+            _request_done()
+            raise
+        # las respuestas en streaming cuentan como activas hasta que se cierran
+        return ClosingIterator(app_iter, _request_done)
+    return wrapped
+
+app.wsgi_app = _track_active(app.wsgi_app)
+
+def inherited_fd():
+    """Devuelve (fd, origen) del socket heredado o (None, None)."""
+    listen_pid = os.environ.pop("LISTEN_PID", None)
+    listen_fds = os.environ.pop("LISTEN_FDS", None)
+    os.environ.pop("LISTEN_FDNAMES", None)
+    if listen_pid == str(os.getpid()) and listen_fds and int(listen_fds) >= 1:
+        return SD_LISTEN_FDS_START, "systemd"
+    fd = os.environ.pop("RADIOSTREAM_FD", None)
+    if fd:
+        return int(fd), "relevo"
+    return None, None
+
+def sd_notify(message):
+    addr = os.environ.get("NOTIFY_SOCKET")
+    if not addr:
+        return
+    import socket
+    if addr.startswith("@"):
+        addr = "\0" + addr[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(addr)
+            s.sendall(message.encode())
+    except OSError as e:
+        app.logger.debug("sd_notify falló: %s", e)
+
+def _signal_ready():
+    sd_notify(f"MAINPID={os.getpid()}\nREADY=1")
+    ready_fd = os.environ.pop("RADIOSTREAM_READY_FD", None)
+    if ready_fd:
+        try:
+            os.write(int(ready_fd), b"1")
+        finally:
+            os.close(int(ready_fd))
+
+def make_listening_server(host, port):
+    import socket
+    from werkzeug.serving import make_server
+
+    fd, origin = inherited_fd()
+    if fd is not None:
+        sock = socket.socket(fileno=os.dup(fd))
+        try:
+            bound_port = sock.getsockname()[1]
+            family = sock.family
+        finally:
+            sock.close()
+        if origin == "relevo" and bound_port != port:
+            # cambio de puerto: el sucesor abre el suyo y el socket viejo se suelta
+            os.close(fd)
+            fd = None
+        else:
+            if bound_port != port:
+                print(f"Aviso: el socket heredado escucha en {bound_port}, no en {port}.")
+            port = bound_port
+            if family == socket.AF_INET6:
+                host = "::"
+    server = make_server(host, port, app, threaded=True, fd=fd)
+    if fd is not None:
+        os.close(fd)  # werkzeug trabaja sobre un duplicado
+    return server, origin
+
+def _drain(timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _active_lock:
+            if _active_requests <= 0:
+                return True
+        time.sleep(0.1)
+    return False
+
+def _handover(server):
+    """Arranca un sucesor con el socket heredado y se retira cuando está listo."""
+    if shutting_down.is_set() or not _handover_lock.acquire(blocking=False):
+        return
+    try:
+        _spawn_successor(server)
+    finally:
+        _handover_lock.release()
+
+def _spawn_successor(server):
+    import select
+    import subprocess
+
+    flush_config()
+    fd = server.socket.fileno()
+    os.set_inheritable(fd, True)
+    ready_r, ready_w = os.pipe()
+    env = dict(os.environ, RADIOSTREAM_FD=str(fd), RADIOSTREAM_READY_FD=str(ready_w))
+    try:
+        proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve())] + sys.argv[1:],
+                                env=env, pass_fds=(fd, ready_w))
+    except OSError as e:
+        print(f"Relevo cancelado: no se pudo lanzar el sucesor ({e})")
+        os.close(ready_r)
+        os.close(ready_w)
+        return
+    os.close(ready_w)
+    try:
+        readable, _, _ = select.select([ready_r], [], [], 60)
+        ok = bool(readable) and os.read(ready_r, 1) == b"1"
+    finally:
+        os.close(ready_r)
+    if not ok:
+        print("Relevo cancelado: el sucesor no llegó a estar listo; sigo sirviendo.")
+        if proc.poll() is None:
+            proc.terminate()
+        return
+    print(f"Relevo completado (pid {proc.pid}); drenando conexiones abiertas.")
+    _stop(server)
+
+def _stop(server):
+    if not shutting_down.is_set():
+        shutting_down.set()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+def serve(host, port):
+    server, origin = make_listening_server(host, port)
+    signal.signal(signal.SIGTERM, lambda *_: _stop(server))
+    signal.signal(signal.SIGINT, lambda *_: _stop(server))
+    signal.signal(signal.SIGHUP,
+                  lambda *_: threading.Thread(target=_handover, args=(server,), daemon=True).start())
+    where = f" (socket heredado de {origin})" if origin else ""
+    print(f"Escuchando en http://{host}:{server.port}{where}")
+    _signal_ready()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    if not _drain(config.get("drain_timeout", DEFAULT_DRAIN_TIMEOUT)):
+        print("Tiempo de drenado agotado; se cierran las conexiones restantes.")
+    flush_config()
+
 # ---------------- Run ----------------
 if __name__ == "__main__":
-    port_to_use = config.get("port", DEFAULT_PORT)
+    import argparse
+    parser = argparse.ArgumentParser(description="RadioStream")
+    parser.add_argument("--port", type=int, help="puerto (por defecto el de config.json)")
+    parser.add_argument("--bench-startup", action="store_true",
+                        help="mide import y tiempo hasta el primer byte y sale")
+    parser.add_argument("--export", metavar="DIR",
+                        help="exporta las páginas públicas a DIR para nginx/CDN y sale")
+    parser.add_argument("--bench-ttfa", action="store_true",
+                        help="mide el tiempo hasta el primer audio (origen directo frente al relay) y sale")
+    parser.add_argument("--bench-stream", metavar="LECTORES", type=int, nargs="?", const=2000,
+                        help="prueba de estrés de las colas de streaming con lectores lentos (2000 por defecto) y sale")
+    parser.add_argument("--tone-source", metavar="PUERTO", type=int,
+                        help="sirve un stream WAV de prueba (tono de 440 Hz) en 127.0.0.1:PUERTO")
+    parser.add_argument("--tone-pattern", metavar="TONO:SILENCIO", default="30:0",
+                        help="segundos de tono y de silencio del stream de prueba (p. ej. 20:20)")
+    args = parser.parse_args()
+
+    if args.bench_startup:
+        bench_startup()
+        sys.exit(0)
+    if args.bench_ttfa:
+        bench_ttfa()
+        sys.exit(0)
+    if args.bench_stream:
+        bench_stream(args.bench_stream)
+        sys.exit(0)
+    if args.export:
+        print(f"Exportado en {export_static(args.export)}")
+        sys.exit(0)
+    if args.tone_source:
+        tone_s, silence_s = (float(x) for x in args.tone_pattern.split(":"))
+        print(f"Stream de prueba en http://127.0.0.1:{args.tone_source}/ ({tone_s:g} s tono / {silence_s:g} s silencio)")
+        serve_tone(args.tone_source, tone_s, silence_s).serve_forever()
+
+    warm_up()
+    start_asset_watcher()
+    apply_recorder_config()
+    apply_analysis_config()
+    apply_relay_config()
+    apply_transcode_config()
+    schedule_static_export(0)
+    port_to_use = args.port or config.get("port", DEFAULT_PORT)
     print("------------------------------------------------------------")
     print("RadioStream - servidor de administración")
-    print(f"Escuchando en http://0.0.0.0:{port_to_use}")
     print("Accede a /admin para configurar. Credenciales por defecto: admin / admin")
     print("Usa /embed (o /embed?autoplay=1) para el reproductor embebible (iframe).")
-    print("Para que un cambio de puerto tome efecto debes reiniciar el servidor.")
+    print("Envía SIGHUP (systemctl reload) para relevar el proceso sin cortar conexiones.")
     print("------------------------------------------------------------")
-    app.run(host="0.0.0.0", port=port_to_use, debug=False)
+    serve("0.0.0.0", port_to_use)